@@ -0,0 +1,216 @@
+"""
+AI音乐生成器 Web版 - 生产服务器（ASGI）
+
+与 web_app.py 提供相同的接口，区别在于：
+- 请求处理函数是异步的，等待生成结果时不占用线程（asyncio.wrap_future 等待流水线的Future），
+  一个进程可以同时挂起任意多个长时间的生成请求
+- 使用uvicorn运行，可以配置工作进程数和keep-alive超时
+- 优雅关闭：收到SIGTERM/SIGINT后不再接受新连接，等待进行中的请求完成，
+  最后排空生成流水线中已经提交的任务
+
+所有处理函数都只是对共享的 MusicService 的一层薄封装（见 src/service.py）。
+
+使用方法:
+    python asgi_app.py --port 8080 --workers 1 --keep-alive 5 --graceful-timeout 60
+
+    # 模拟引擎（不加载模型），用于压测服务层
+    python asgi_app.py --engine stub
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入标准库
+import argparse  # 用于解析命令行参数
+import asyncio  # 异步等待生成结果
+import contextlib  # 用于定义lifespan
+import json  # 用于向工作进程传递配置
+import os  # 用于读取环境变量
+
+# 导入第三方库
+import uvicorn  # ASGI服务器
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from starlette.templating import Jinja2Templates
+
+# 导入我们自己的模块
+from src.service import (
+    FAST_GUIDANCE_STEPS,
+    STATIC_FOLDER,
+    MemoryBudgetExceeded,
+    MusicService,
+    RequestError,
+    ServiceUnavailable,
+    add_service_arguments,
+    service_options,
+)
+
+# 多进程（--workers）时，主进程通过这个环境变量把服务配置传给每个工作进程
+CONFIG_ENV = "MUSIC_APP_CONFIG"
+
+# 模板目录
+TEMPLATES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+def error_response(message, status_code):
+    """与 web_app.py 格式相同的错误响应"""
+    return JSONResponse({"success": False, "error": message}, status_code=status_code)
+
+
+def create_app(service=None, preload=()):
+    """
+    创建ASGI应用
+
+    参数:
+        service (MusicService, 可选): 生成服务，默认按环境变量 MUSIC_APP_CONFIG 中的配置创建
+        preload (tuple[str]): 启动时提前加载的模型，默认使用环境变量中的配置
+
+    返回值:
+        Starlette: ASGI应用
+    """
+    if service is None:
+        config = json.loads(os.environ.get(CONFIG_ENV, "{}"))
+        service = MusicService(**service_options(config))
+        preload = preload or tuple(config.get("preload") or ())
+    templates = Jinja2Templates(directory=TEMPLATES_FOLDER)
+
+    async def index(request):
+        return templates.TemplateResponse(request, "index.html", {"fast_guidance_steps": FAST_GUIDANCE_STEPS})
+
+    async def generate(request):
+        return await run_generation(request, service.parse_generate_request)
+
+    async def continue_generation(request):
+        """接着一段已有的音频（之前的generation_id或上传的WAV）续写"""
+        return await run_generation(request, service.parse_continue_request)
+
+    async def run_generation(request, parse_request):
+        """解析请求、提交生成并等待完成，/generate 和 /continue 共用"""
+        try:
+            data = await request.json()
+        except ValueError:
+            return error_response("请求内容必须是JSON", 400)
+
+        try:
+            # 续写请求要读取和解码开头的WAV，放到线程中执行，不阻塞事件循环
+            generate_request = await asyncio.to_thread(parse_request, data)
+            future = service.submit(generate_request)
+        except RequestError as e:
+            return error_response(str(e), 400)
+        except ServiceUnavailable as e:
+            return error_response(str(e), 503)
+        except MemoryBudgetExceeded as e:
+            return error_response(str(e), 413)
+
+        # 等待流水线完成，期间不占用任何线程
+        try:
+            result = await asyncio.wrap_future(future)
+            return JSONResponse(service.generate_response(generate_request, result))
+        except Exception as e:
+            return error_response(str(e), 500)
+
+    async def stats(request):
+        """各模型流水线的阶段耗时和内存统计"""
+        return JSONResponse(service.stats())
+
+    async def health(request):
+        if service.draining:
+            return JSONResponse({"status": "draining"}, status_code=503)
+        return JSONResponse({"status": "healthy"})
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        # 提前加载模型，避免第一个请求等待
+        if preload:
+            await asyncio.to_thread(service.preload, preload)
+        yield
+        # 走到这里时uvicorn已经停止接受新连接，并等待了进行中的请求（--graceful-timeout）；
+        # 最后排空流水线，保证已经提交的任务都写完文件
+        print("🛑 正在关闭，等待生成流水线中的任务完成...")
+        await asyncio.to_thread(service.shutdown, True)
+        print("✅ 生成流水线已排空")
+
+    routes = [
+        Route("/", index),
+        Route("/generate", generate, methods=["POST"]),
+        Route("/continue", continue_generation, methods=["POST"]),
+        Route("/stats", stats),
+        Route("/health", health),
+        Mount("/static", StaticFiles(directory=STATIC_FOLDER), name="static"),
+    ]
+    app = Starlette(routes=routes, lifespan=lifespan)
+    app.state.service = service
+    return app
+
+
+def main():
+    """
+    主函数 - 解析参数，用uvicorn启动服务
+    """
+    parser = argparse.ArgumentParser(description="AI音乐生成器 Web版（生产服务器）")
+    add_service_arguments(parser)
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="监听地址")
+    parser.add_argument("--port", type=int, default=8080, help="监听端口")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="工作进程数；每个进程各自加载一份模型，内存需求按进程数成倍增加",
+    )
+    parser.add_argument("--keep-alive", type=int, default=5, help="空闲keep-alive连接的超时时间（秒）")
+    parser.add_argument(
+        "--graceful-timeout",
+        type=int,
+        default=60,
+        help="关闭时等待进行中请求的最长时间（秒），超时后断开连接，流水线中的任务仍会完成",
+    )
+    parser.add_argument(
+        "--worker-timeout",
+        type=int,
+        default=60,
+        help="多进程时工作进程的健康检查超时（秒）；导入torch较慢，太短会导致工作进程被反复重启",
+    )
+    parser.add_argument("--limit-concurrency", type=int, default=None, help="同时处理的连接数上限，超过时返回503")
+    parser.add_argument("--backlog", type=int, default=2048, help="等待accept的连接队列长度")
+    parser.add_argument(
+        "--preload",
+        nargs="*",
+        choices=["small", "medium"],
+        default=[],
+        help="启动时提前加载的模型",
+    )
+    args = parser.parse_args()
+
+    # 工作进程由uvicorn重新导入这个模块，配置通过环境变量传递
+    config = {
+        "compile": args.compile,
+        "engine": args.engine,
+        "stub_step_ms": args.stub_step_ms,
+        "stub_decode_ms": args.stub_decode_ms,
+        "memory_budget_gb": args.memory_budget_gb,
+        "memory_policy": args.memory_policy,
+        "preload": args.preload,
+    }
+    os.environ[CONFIG_ENV] = json.dumps(config)
+
+    print("🎵 AI音乐生成器 Web版（ASGI）启动中...")
+    print(f"🌐 访问地址: http://localhost:{args.port}")
+    uvicorn.run(
+        "asgi_app:create_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        timeout_worker_healthcheck=args.worker_timeout,
+        limit_concurrency=args.limit_concurrency,
+        backlog=args.backlog,
+    )
+
+
+# 这是Python的特殊语法，表示"如果直接运行这个文件"
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Web服务压测工具
+
+向 /generate 和生成的音频文件（/static/generated/...）发送并发请求，
+统计每个接口的延迟分位数（p50/p95/p99）、吞吐量和错误率。
+
+两种发压方式：
+- 闭环（默认）: --concurrency 个客户端，每个客户端收到响应后立即发送下一个请求
+- 开环: --rate 指定每秒到达的请求数（泊松到达），不管服务器是否跟得上；
+  延迟从计划发送的时刻开始计算，服务器变慢时排队时间也会计入延迟
+
+不指定 --url 时会在本进程内启动Web服务（默认asgi_app，--server flask 使用web_app），
+并使用模拟引擎（不加载模型），
+所以可以在任何机器上单独测试服务层（排队、流水线、文件服务）的容量。
+
+使用方法:
+    # 进程内启动模拟引擎，8个并发客户端，共100个请求
+    python loadtest.py --concurrency 8 --requests 100
+
+    # 开环：每秒2个请求，持续60秒
+    python loadtest.py --rate 2 --duration 60
+
+    # 压测已经启动的服务（例如 python asgi_app.py --engine stub）
+    python loadtest.py --url http://localhost:8080 --concurrency 4 --requests 50
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入标准库
+import argparse  # 用于解析命令行参数
+import json  # 用于请求和结果的序列化
+import random  # 用于开环模式的泊松到达
+import threading  # 并发客户端
+import time  # 用于计时
+import urllib.error  # HTTP错误
+import urllib.request  # HTTP客户端
+from concurrent.futures import ThreadPoolExecutor  # 开环模式的请求线程池
+
+# 报告的延迟分位数
+PERCENTILES = (50, 95, 99)
+
+# 服务端内存统计的单位换算
+MB = 1024 * 1024
+
+
+class Recorder:
+    """线程安全地记录每个接口的请求结果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+
+    def add(self, route, seconds, error=None):
+        """
+        记录一个请求
+
+        参数:
+            route (str): 接口名称
+            seconds (float): 请求耗时（秒）
+            error (str, 可选): 错误类型（HTTP状态码或异常类名），None表示成功
+        """
+        with self._lock:
+            result = self.routes.setdefault(route, {"latencies": [], "errors": {}})
+            if error is None:
+                result["latencies"].append(seconds)
+            else:
+                result["errors"][error] = result["errors"].get(error, 0) + 1
+
+
+def percentile(sorted_values, q):
+    """最近秩法计算分位数，sorted_values必须已经排序"""
+    if not sorted_values:
+        return float("nan")
+    index = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder, elapsed):
+    """
+    汇总每个接口的统计结果
+
+    参数:
+        recorder (Recorder): 记录的请求结果
+        elapsed (float): 压测总时长（秒）
+
+    返回值:
+        dict: 接口名 -> {requests, errors, error_rate, throughput, mean, max, p50, p95, p99}（延迟单位：毫秒）
+    """
+    summary = {}
+    for route, result in recorder.routes.items():
+        latencies = sorted(result["latencies"])
+        errors = sum(result["errors"].values())
+        total = len(latencies) + errors
+        summary[route] = {
+            "requests": total,
+            "errors": result["errors"],
+            "error_rate": errors / total if total else 0.0,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "mean": sum(latencies) / len(latencies) * 1000 if latencies else float("nan"),
+            "max": latencies[-1] * 1000 if latencies else float("nan"),
+            **{f"p{q}": percentile(latencies, q) * 1000 for q in PERCENTILES},
+        }
+    return summary
+
+
+class LoadTest:
+    """
+    向Web服务发压的客户端
+
+    每个"请求"是一次 /generate 调用，成功后再下载每个变体的音频文件（--no-fetch-audio 关闭）。
+    """
+
+    def __init__(self, base_url, payload, fetch_audio=True, timeout=600):
+        """
+        参数:
+            base_url (str): 服务地址，例如 http://localhost:8080
+            payload (dict): /generate 的请求体
+            fetch_audio (bool): 是否下载生成的音频文件
+            timeout (float): 单个HTTP请求的超时时间（秒）
+        """
+        self.base_url = base_url.rstrip("/")
+        self.payload = payload
+        self.fetch_audio = fetch_audio
+        self.timeout = timeout
+        self.recorder = Recorder()
+
+    def _request(self, route, path, data=None, started=None):
+        """发送一个HTTP请求并记录结果，返回响应内容（失败时返回None）"""
+        started = started if started is not None else time.perf_counter()
+        request = urllib.request.Request(self.base_url + path, data=data)
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = response.read()
+        except urllib.error.HTTPError as e:
+            self.recorder.add(route, time.perf_counter() - started, error=f"HTTP {e.code}")
+            return None
+        except Exception as e:
+            self.recorder.add(route, time.perf_counter() - started, error=type(e).__name__)
+            return None
+        self.recorder.add(route, time.perf_counter() - started)
+        return body
+
+    def run_one(self, scheduled=None):
+        """
+        执行一次完整的请求：/generate，然后下载音频文件
+
+        参数:
+            scheduled (float, 可选): 开环模式下计划发送的时刻，延迟从这个时刻开始计算
+        """
+        body = self._request("/generate", "/generate", json.dumps(self.payload).encode(), started=scheduled)
+        if body is None or not self.fetch_audio:
+            return
+        result = json.loads(body)
+        for variation in result.get("variations", []):
+            self._request("/static/generated", variation["audio_url"])
+
+    def closed_loop(self, concurrency, num_requests=None, duration=None):
+        """
+        闭环压测：concurrency个客户端各自循环发送请求
+
+        参数:
+            concurrency (int): 并发客户端数量
+            num_requests (int, 可选): 总请求数
+            duration (float, 可选): 压测时长（秒），与num_requests至少指定一个
+        """
+        lock = threading.Lock()
+        remaining = [num_requests]
+        deadline = time.perf_counter() + duration if duration else None
+
+        def client():
+            while deadline is None or time.perf_counter() < deadline:
+                if num_requests is not None:
+                    with lock:
+                        if remaining[0] <= 0:
+                            return
+                        remaining[0] -= 1
+                self.run_one()
+
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def open_loop(self, rate, num_requests=None, duration=None, max_in_flight=256, seed=None):
+        """
+        开环压测：按泊松过程以固定速率发送请求，不等待之前的请求完成
+
+        参数:
+            rate (float): 平均每秒到达的请求数
+            num_requests (int, 可选): 总请求数
+            duration (float, 可选): 发送请求的时长（秒）
+            max_in_flight (int): 同时进行中的请求数上限（客户端线程数）
+            seed (int, 可选): 到达时间的随机种子
+        """
+        arrivals = random.Random(seed)
+        start = time.perf_counter()
+        scheduled = start
+        sent = 0
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            while num_requests is None or sent < num_requests:
+                scheduled += arrivals.expovariate(rate)
+                if duration is not None and scheduled - start >= duration:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.run_one, scheduled)
+                sent += 1
+
+    def server_stats(self):
+        """读取服务端的流水线阶段统计（/stats），失败时返回None"""
+        try:
+            with urllib.request.urlopen(self.base_url + "/stats", timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except Exception:
+            return None
+
+
+def start_stub_server(step_ms, decode_ms, server="asgi", memory_budget_gb=None):
+    """
+    在本进程内启动使用模拟引擎的Web服务
+
+    参数:
+        step_ms (float): 模拟引擎每一步解码的耗时（毫秒）
+        decode_ms (float): 模拟引擎每秒音频的解码耗时（毫秒）
+        server (str): "asgi"（asgi_app.py + uvicorn）或 "flask"（web_app.py + 开发服务器）
+        memory_budget_gb (float, 可选): 服务端的内存预算（GB），用于测试内存守卫的排队和拒绝
+
+    返回值:
+        tuple: (服务地址, 停止服务的函数)
+    """
+    options = {"engine": "stub", "stub_step_ms": step_ms, "stub_decode_ms": decode_ms, "memory_budget_gb": memory_budget_gb}
+
+    if server == "flask":
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        import web_app
+        from src.service import service_options
+
+        web_app.app.config["SERVICE_OPTIONS"] = service_options(options)
+
+        class QuietHandler(WSGIRequestHandler):
+            # 不打印每个请求的访问日志，避免淹没压测报告
+            def log_request(self, *args, **kwargs):
+                pass
+
+        wsgi_server = make_server("127.0.0.1", 0, web_app.app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=wsgi_server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{wsgi_server.server_port}", wsgi_server.shutdown
+
+    import socket
+
+    import uvicorn
+
+    import asgi_app
+    from src.service import MusicService, service_options
+
+    app = asgi_app.create_app(MusicService(**service_options(options)))
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    asgi_server = uvicorn.Server(uvicorn.Config(app, log_level="warning", access_log=False))
+    thread = threading.Thread(target=asgi_server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not asgi_server.started:
+        time.sleep(0.01)
+
+    def stop():
+        asgi_server.should_exit = True
+        thread.join()
+
+    return f"http://127.0.0.1:{sock.getsockname()[1]}", stop
+
+
+def print_report(summary, elapsed, stats):
+    """打印压测报告"""
+    print(f"\n📊 压测结果（总时长 {elapsed:.1f}秒）")
+    print(
+        f"{'接口':<20}{'请求数':>8}{'错误率':>9}{'吞吐(/秒)':>11}"
+        f"{'平均':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'最大':>10}"
+    )
+    for route, result in summary.items():
+        print(
+            f"{route:<20}{result['requests']:>8}{result['error_rate']:>9.1%}{result['throughput']:>11.2f}"
+            f"{result['mean']:>10.1f}{result['p50']:>10.1f}{result['p95']:>10.1f}{result['p99']:>10.1f}{result['max']:>10.1f}"
+        )
+        for error, count in result["errors"].items():
+            print(f"  ❌ {error}: {count}")
+    print("（延迟单位：毫秒）")
+
+    if stats:
+        stats = dict(stats)
+        guard = stats.pop("memory_guard", None)
+        print("\n⏱️ 服务端流水线各阶段平均耗时（秒）")
+        for model_size, stages in stats.items():
+            means = ", ".join(
+                f"{stage} {values['mean']:.3f}" for stage, values in stages.items() if "mean" in values
+            )
+            print(f"  {model_size}: {means}")
+
+        print("\n💾 服务端内存（MB）")
+        for model_size, stages in stats.items():
+            memory = stages.get("memory")
+            if memory:
+                print(
+                    f"  {model_size}: token阶段峰值增量 {memory['tokens_peak'] / MB:.0f}, "
+                    f"解码阶段峰值增量 {memory['decode_peak'] / MB:.0f}, "
+                    f"最近一次释放后RSS {(memory['rss_after'] or 0) / MB:.0f}"
+                )
+        if guard:
+            print(
+                f"  内存守卫: 预算 {guard['budget'] / MB:.0f}, 最大预留 {guard['peak_reserved'] / MB:.0f}, "
+                f"拒绝 {guard['rejected']}, 拆分 {guard['split']}, 排队 {guard['waits']} 次共 {guard['wait_time']:.2f}秒"
+            )
+
+        for model_size, stages in stats.items():
+            cache = stages.get("prompt_cache")
+            if cache and cache["hits"] + cache["misses"]:
+                print(
+                    f"\n♻️ {model_size} 续写开头缓存: 命中 {cache['hits']}, 未命中 {cache['misses']}, "
+                    f"节省编码 {cache['saved_time']:.2f}秒"
+                )
+
+
+def main():
+    """
+    主函数 - 解析参数，启动压测，打印报告
+    """
+    parser = argparse.ArgumentParser(description="AI音乐生成器 Web服务压测工具")
+    parser.add_argument("--url", type=str, default=None, help="服务地址，不指定时在进程内启动模拟引擎")
+    parser.add_argument("--concurrency", type=int, default=4, help="闭环模式的并发客户端数量")
+    parser.add_argument("--rate", type=float, default=None, help="开环模式：平均每秒到达的请求数")
+    parser.add_argument("--requests", type=int, default=None, help="总请求数")
+    parser.add_argument("--duration", type=float, default=None, help="压测时长（秒）")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="开环模式下同时进行中的请求数上限")
+    parser.add_argument("--prompt", type=str, default="A calming piano melody", help="请求的提示词")
+    parser.add_argument("--model", type=str, choices=["small", "medium"], default="small", help="请求的模型")
+    parser.add_argument("--num-variations", type=int, default=1, help="每个请求的变体数量")
+    parser.add_argument("--tier", type=str, default="standard", help="生成档位 (standard/fast)")
+    parser.add_argument("--no-fetch-audio", action="store_true", help="不下载生成的音频文件")
+    parser.add_argument("--stub-step-ms", type=float, default=15.0, help="进程内模拟引擎：每一步解码的耗时（毫秒）")
+    parser.add_argument("--stub-decode-ms", type=float, default=20.0, help="进程内模拟引擎：每秒音频的解码耗时（毫秒）")
+    parser.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        default=None,
+        help="进程内模拟引擎：服务端的内存预算（GB），用于测试内存守卫",
+    )
+    parser.add_argument(
+        "--server",
+        choices=["asgi", "flask"],
+        default="asgi",
+        help="进程内启动的服务器：asgi_app.py（uvicorn）或 web_app.py（Flask开发服务器）",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="开环模式到达时间的随机种子")
+    parser.add_argument("--json", type=str, default=None, help="把结果另存为JSON文件")
+    args = parser.parse_args()
+
+    if args.requests is None and args.duration is None:
+        args.requests = 20
+
+    url, stop_server = args.url, None
+    if url is None:
+        url, stop_server = start_stub_server(
+            args.stub_step_ms, args.stub_decode_ms, server=args.server, memory_budget_gb=args.memory_budget_gb
+        )
+        print(f"🧪 已在进程内启动模拟引擎 ({args.server}): {url}")
+
+    payload = {
+        "prompt": args.prompt,
+        "model": args.model,
+        "num_variations": args.num_variations,
+        "tier": args.tier,
+    }
+    load_test = LoadTest(url, payload, fetch_audio=not args.no_fetch_audio)
+
+    if args.rate:
+        print(f"🚀 开环压测: {args.rate}请求/秒")
+    else:
+        print(f"🚀 闭环压测: {args.concurrency}个并发客户端")
+    start = time.perf_counter()
+    if args.rate:
+        load_test.open_loop(args.rate, args.requests, args.duration, args.max_in_flight, seed=args.seed)
+    else:
+        load_test.closed_loop(args.concurrency, args.requests, args.duration)
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(load_test.recorder, elapsed)
+    stats = load_test.server_stats()
+    print_report(summary, elapsed, stats)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"elapsed": elapsed, "routes": summary, "server_stats": stats}, f, indent=2, ensure_ascii=False)
+        print(f"💾 结果已保存: {args.json}")
+
+    if stop_server is not None:
+        stop_server()
+
+
+# 这是Python的特殊语法，表示"如果直接运行这个文件"
+if __name__ == "__main__":
+    main()
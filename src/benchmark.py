@@ -0,0 +1,174 @@
+"""
+解码单步延迟基准测试 - eager vs 编译模式
+
+这个脚本分别用eager模式（动态KV缓存）和编译模式（静态KV缓存 + torch.compile）
+运行同样的解码循环，统计每一步解码的耗时。
+
+使用方法:
+    # 使用真实模型（需要下载模型）
+    python benchmark.py --model small --max-tokens 256
+
+    # 使用随机权重（网络结构与small相同，不需要下载模型）
+    # 单步延迟只取决于网络结构和输入形状，与权重的具体数值无关
+    python benchmark.py --random-weights --max-tokens 128
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入标准库
+import argparse  # 用于解析命令行参数
+import statistics  # 用于计算中位数等统计量
+import time  # 用于计时
+
+# 导入第三方库
+import torch  # PyTorch深度学习框架
+from transformers import (
+    EncodecConfig,
+    MusicgenConfig,
+    MusicgenDecoderConfig,
+    MusicgenForConditionalGeneration,
+    T5Config,
+)
+
+# 导入我们自己的模块
+from models.decoding import DecoderStep, encode_text, make_generators, sample_audio_codes
+from models.musicgen import MusicGen
+from utils.device import get_optimal_device
+
+# 各模型解码器的结构参数（与Hugging Face上的facebook/musicgen-*一致）
+DECODER_SIZES = {
+    "small": dict(hidden_size=1024, num_hidden_layers=24, num_attention_heads=16, ffn_dim=4096),
+    "medium": dict(hidden_size=1536, num_hidden_layers=48, num_attention_heads=24, ffn_dim=6144),
+}
+
+
+def build_random_model(model_size, device):
+    """
+    创建随机权重的MusicGen模型
+
+    解码器的结构与真实模型相同；文本编码器和音频编解码器在基准测试中用不到，
+    所以只用很小的配置，节省内存。
+
+    参数:
+        model_size (str): "small" 或 "medium"
+        device (torch.device): 计算设备
+
+    返回值:
+        MusicgenForConditionalGeneration: 随机初始化的模型
+    """
+    decoder = MusicgenDecoderConfig(
+        vocab_size=2048,
+        num_codebooks=4,
+        max_position_embeddings=2048,
+        pad_token_id=2048,
+        bos_token_id=2048,
+        decoder_start_token_id=2048,
+        **DECODER_SIZES[model_size],
+    )
+    text_encoder = T5Config(vocab_size=32128, d_model=64, d_kv=16, d_ff=128, num_layers=1, num_heads=4)
+    audio_encoder = EncodecConfig(sampling_rate=32000, codebook_size=2048)
+    config = MusicgenConfig(
+        text_encoder=text_encoder.to_dict(),
+        audio_encoder=audio_encoder.to_dict(),
+        decoder=decoder.to_dict(),
+    )
+
+    model = MusicgenForConditionalGeneration(config).eval().to(device)
+    # 与真实模型的默认生成配置一致
+    generation_config = model.generation_config
+    generation_config.pad_token_id = 2048
+    generation_config.decoder_start_token_id = 2048
+    generation_config.do_sample = True
+    generation_config.top_k = 250
+    generation_config.guidance_scale = 3.0
+    return model
+
+
+def measure(model, encoder_hidden_states, encoder_attention_mask, decoder_step, max_tokens, seeds):
+    """
+    运行一次完整的解码循环，返回每一步的耗时（毫秒，不含第一步）
+
+    第一步（写入交叉注意力缓存）两种模式都用eager执行，所以不计入统计。
+    """
+    decoder_step.step_times = []
+    decoder_step.record_times = True
+    with torch.no_grad():
+        sample_audio_codes(
+            model,
+            encoder_hidden_states,
+            encoder_attention_mask,
+            max_new_tokens=max_tokens,
+            generators=make_generators(seeds, model.device),
+            decoder_step=decoder_step,
+        )
+    decoder_step.record_times = False
+    return [seconds * 1000 for seconds in decoder_step.step_times[1:]]
+
+
+def main():
+    """
+    主函数 - 解析参数，依次测试eager模式和编译模式，打印对比结果
+    """
+    parser = argparse.ArgumentParser(description="解码单步延迟基准测试 (eager vs 编译)")
+    parser.add_argument("--model", type=str, choices=["small", "medium"], default="small", help="模型大小")
+    parser.add_argument("--max-tokens", type=int, default=128, help="每次解码生成的token数")
+    parser.add_argument("--batch-size", type=int, default=1, help="batch大小（变体数量）")
+    parser.add_argument("--repeats", type=int, default=3, help="每种模式重复测试的次数")
+    parser.add_argument("--random-weights", action="store_true", help="使用随机权重，不下载模型")
+    args = parser.parse_args()
+
+    device, device_name = get_optimal_device()
+    print(f"使用设备: {device_name}")
+
+    seeds = list(range(args.batch_size))
+    if args.random_weights:
+        model = build_random_model(args.model, device)
+        # 用随机的文本编码代替真实提示词（长度12，与普通提示词相近）
+        encoder_hidden_states = torch.randn(args.batch_size, 12, model.decoder.config.hidden_size, device=device)
+        encoder_attention_mask = torch.ones(args.batch_size, 12, dtype=torch.long, device=device)
+    else:
+        generator = MusicGen(model_size=args.model, device=device)
+        generator.load_model()
+        model = generator.model
+        with torch.no_grad():
+            encoder_hidden_states, encoder_attention_mask = encode_text(
+                model, generator.processor, ["A calming piano melody"], device, num_variations=args.batch_size
+            )
+
+    results = {}
+    for mode in ("eager", "compiled"):
+        decoder_step = DecoderStep(model, compile=mode == "compiled")
+
+        # 第一次运行包含编译（或预热）时间，单独统计
+        start_time = time.perf_counter()
+        measure(model, encoder_hidden_states, encoder_attention_mask, decoder_step, args.max_tokens, seeds)
+        warmup = time.perf_counter() - start_time
+
+        step_ms = []
+        for _ in range(args.repeats):
+            step_ms += measure(model, encoder_hidden_states, encoder_attention_mask, decoder_step, args.max_tokens, seeds)
+
+        if mode == "compiled" and not decoder_step.is_compiled:
+            print("⚠️ 编译失败，编译模式的结果实际为eager模式")
+        results[mode] = {
+            "warmup": warmup,
+            "mean": statistics.mean(step_ms),
+            "p50": statistics.median(step_ms),
+            "p90": statistics.quantiles(step_ms, n=10)[-1],
+        }
+
+    print(f"\n📊 模型: {args.model}, token数: {args.max_tokens}, batch: {args.batch_size}")
+    print(f"{'模式':<10}{'首次运行(秒)':>14}{'平均(毫秒/步)':>16}{'p50':>10}{'p90':>10}")
+    for mode, result in results.items():
+        print(
+            f"{mode:<10}{result['warmup']:>14.2f}{result['mean']:>16.2f}"
+            f"{result['p50']:>10.2f}{result['p90']:>10.2f}"
+        )
+    speedup = results["eager"]["mean"] / results["compiled"]["mean"]
+    print(f"\n⚡ 编译模式单步加速: {speedup:.2f}x")
+
+
+# 这是Python的特殊语法，表示"如果直接运行这个文件"
+if __name__ == "__main__":
+    main()
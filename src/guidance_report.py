@@ -0,0 +1,153 @@
+"""
+无分类器引导的速度/质量报告
+
+无分类器引导在每一步解码时都要多算一遍"无条件"分支，计算量翻倍。
+这个脚本对比几种引导方案：
+- 全程引导（默认）
+- 只在前K步引导，之后丢弃无条件分支
+- 不使用引导
+
+对每种方案统计每个请求的耗时、相对完整引导的计算量，以及质量参考指标：
+生成结果在"全程引导"分布下的平均对数概率（越接近全程引导的数值越好）。
+
+使用方法:
+    # 使用真实模型（需要下载模型）
+    python guidance_report.py --model small --max-tokens 256
+
+    # 使用随机权重（只看速度，质量指标没有参考意义）
+    python guidance_report.py --random-weights --max-tokens 128 --steps 16 32
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入标准库
+import argparse  # 用于解析命令行参数
+import statistics  # 用于计算平均值
+import time  # 用于计时
+
+# 导入第三方库
+import torch  # PyTorch深度学习框架
+
+# 导入我们自己的模块
+from benchmark import build_random_model
+from models.decoding import FAST_GUIDANCE_STEPS, encode_text, make_generators, sample_audio_codes, score_audio_codes
+from models.musicgen import MusicGen
+from utils.device import get_optimal_device
+
+# 报告中使用的提示词，覆盖几种常见的风格
+PROMPTS = [
+    "A calming piano melody",
+    "An energetic electronic dance track with heavy bass",
+    "A smooth jazz piece with saxophone and walking bass",
+]
+
+
+def run_schedule(model, encoder_states, max_tokens, seeds, guidance_scale, guidance_steps):
+    """
+    用一种引导方案为每个提示词生成音频token，并计算质量指标
+
+    参数:
+        model (MusicgenForConditionalGeneration): 已加载的模型
+        encoder_states (list[tuple]): 每个提示词的 (文本编码, 注意力掩码)
+        max_tokens (int): 生成的token数
+        seeds (list[int]): 每个变体的随机种子
+        guidance_scale (float): 生成时使用的引导系数
+        guidance_steps (int): 只在前K步使用引导，None表示全程引导
+
+    返回值:
+        tuple: (每个请求的耗时列表, 每个变体的平均对数概率列表)
+    """
+    seconds, scores = [], []
+    with torch.no_grad():
+        for encoder_hidden_states, encoder_attention_mask in encoder_states:
+            start_time = time.perf_counter()
+            audio_codes = sample_audio_codes(
+                model,
+                encoder_hidden_states,
+                encoder_attention_mask,
+                max_new_tokens=max_tokens,
+                generators=make_generators(seeds, model.device),
+                guidance_scale=guidance_scale,
+                guidance_steps=guidance_steps,
+            )
+            if audio_codes.device.type == "cuda":
+                torch.cuda.synchronize(audio_codes.device)
+            seconds.append(time.perf_counter() - start_time)
+
+            # 质量指标始终在完整引导（模型默认的引导系数）下计算
+            scores += score_audio_codes(model, encoder_hidden_states, encoder_attention_mask, audio_codes).tolist()
+    return seconds, scores
+
+
+def main():
+    """
+    主函数 - 解析参数，依次运行每种引导方案，打印对比结果
+    """
+    parser = argparse.ArgumentParser(description="无分类器引导的速度/质量报告")
+    parser.add_argument("--model", type=str, choices=["small", "medium"], default="small", help="模型大小")
+    parser.add_argument("--max-tokens", type=int, default=256, help="每次生成的token数")
+    parser.add_argument("--num-variations", type=int, default=2, help="每个提示词生成的变体数量")
+    parser.add_argument(
+        "--steps",
+        type=int,
+        nargs="+",
+        default=[16, FAST_GUIDANCE_STEPS, 64],
+        help="要对比的引导步数K（只在前K步使用引导）",
+    )
+    parser.add_argument("--random-weights", action="store_true", help="使用随机权重，不下载模型")
+    args = parser.parse_args()
+
+    device, device_name = get_optimal_device()
+    print(f"使用设备: {device_name}")
+
+    if args.random_weights:
+        model = build_random_model(args.model, device)
+        # 用随机的文本编码代替真实提示词（长度12，与普通提示词相近）
+        encoder_states = [
+            (
+                torch.randn(args.num_variations, 12, model.decoder.config.hidden_size, device=device),
+                torch.ones(args.num_variations, 12, dtype=torch.long, device=device),
+            )
+            for _ in PROMPTS
+        ]
+    else:
+        generator = MusicGen(model_size=args.model, device=device)
+        generator.load_model()
+        model = generator.model
+        with torch.no_grad():
+            encoder_states = [
+                encode_text(model, generator.processor, [prompt], device, num_variations=args.num_variations)
+                for prompt in PROMPTS
+            ]
+
+    guidance_scale = model.generation_config.guidance_scale
+    seeds = list(range(args.num_variations))
+    schedules = [("全程引导", guidance_scale, None)]
+    schedules += [(f"前{steps}步引导", guidance_scale, steps) for steps in sorted(args.steps)]
+    schedules += [("不使用引导", 1.0, None)]
+
+    # 预热一次，避免第一种方案的耗时包含初始化开销
+    run_schedule(model, encoder_states[:1], min(args.max_tokens, 8), seeds, guidance_scale, None)
+
+    results = []
+    for name, scale, steps in schedules:
+        seconds, scores = run_schedule(model, encoder_states, args.max_tokens, seeds, scale, steps)
+        results.append((name, statistics.mean(seconds), statistics.mean(scores)))
+        print(f"✅ {name}: {statistics.mean(seconds):.2f}秒/请求")
+
+    baseline_time, baseline_score = results[0][1], results[0][2]
+    print(f"\n📊 模型: {args.model}, token数: {args.max_tokens}, 提示词: {len(PROMPTS)}, 变体: {args.num_variations}")
+    print(f"{'方案':<12}{'秒/请求':>10}{'相对耗时':>10}{'对数概率':>12}{'差值':>10}")
+    for name, seconds, score in results:
+        print(
+            f"{name:<12}{seconds:>10.2f}{seconds / baseline_time:>10.2f}"
+            f"{score:>12.3f}{score - baseline_score:>10.3f}"
+        )
+    if args.random_weights:
+        print("\n⚠️ 随机权重下对数概率没有参考意义，只看耗时")
+
+
+# 这是Python的特殊语法，表示"如果直接运行这个文件"
+if __name__ == "__main__":
+    main()
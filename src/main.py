@@ -17,10 +17,13 @@ AI音乐生成器 - 主程序入口
 
 # 导入标准库
 import argparse  # 用于解析命令行参数
+import math  # 用于校验引导系数
 
 # 导入我们自己的模块
 from models.musicgen import MusicGen  # 音乐生成模型
+from models.decoding import FAST_GUIDANCE_STEPS  # 快速档位的引导步数
 from utils.device import get_optimal_device  # 设备选择工具
+from utils.audio import AudioPostProcessor, NORMALIZE_MODES, SUPPORTED_SAMPLE_RATES  # 音频后处理
 
 def main():
     """
@@ -71,19 +74,141 @@ def main():
         help="最大生成token数"  # 帮助信息
     )
     
+    # 添加 --num-variations 参数，一次生成多个变体
+    # 提示词只编码一次，所有变体在同一个解码循环中生成
+    parser.add_argument(
+        "--num-variations",
+        type=int,
+        default=1,
+        help="为同一个提示词生成的变体数量"
+    )
+    
+    # 添加 --seed 参数，用于复现结果（第i个变体使用 seed + i）
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="随机种子，默认随机"
+    )
+    
+    # 添加 --compile 参数，启用静态KV缓存 + torch.compile
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="编译解码步骤（首次运行需要编译时间，编译结果会缓存到 ~/.cache/local-ai-music-app）"
+    )
+    
+    # 添加无分类器引导相关参数
+    # 引导每一步都要多算一遍"无条件"分支，关闭或缩短引导可以省掉这部分计算
+    parser.add_argument(
+        "--guidance-scale",
+        type=float,
+        default=None,
+        help="无分类器引导系数，默认3.0，越大越贴合提示词"
+    )
+    parser.add_argument(
+        "--no-guidance",
+        action="store_true",
+        help="关闭无分类器引导（最快，但和提示词的贴合度会下降）"
+    )
+    parser.add_argument(
+        "--guidance-steps",
+        type=int,
+        default=None,
+        help="只在前K步使用引导，之后丢弃无条件分支"
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help=f"快速档位：只在前{FAST_GUIDANCE_STEPS}步使用引导"
+    )
+    
+    # 添加 --continue-from 参数，接着一段已有的音频续写
+    # 开头的音频token按文件内容缓存，同一个进程中反复续写同一段音频时只编码一次
+    parser.add_argument(
+        "--continue-from",
+        type=str,
+        default=None,
+        help="续写：开头的WAV文件路径，输出文件包含开头和续写的部分"
+    )
+    
+    # 添加后处理相关参数
+    # --postprocess 打开后处理，其余参数用于调整各个阶段
+    parser.add_argument(
+        "--postprocess",
+        action="store_true",  # 出现这个参数就为True
+        help="启用音频后处理（去直流、归一化、淡入淡出、重采样）"
+    )
+    parser.add_argument(
+        "--normalize",
+        type=str,
+        choices=NORMALIZE_MODES,
+        default="peak",
+        help="归一化方式 (none/peak/loudness)"
+    )
+    parser.add_argument(
+        "--target-db",
+        type=float,
+        default=None,
+        help="归一化目标电平(dBFS)，peak默认-1，loudness默认-14"
+    )
+    parser.add_argument(
+        "--fade-in",
+        type=float,
+        default=0.0,
+        help="淡入时长(秒)"
+    )
+    parser.add_argument(
+        "--fade-out",
+        type=float,
+        default=0.0,
+        help="淡出时长(秒)"
+    )
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        choices=SUPPORTED_SAMPLE_RATES,
+        default=None,
+        help="输出采样率，默认保持模型的32000Hz"
+    )
+    
     # 解析命令行参数
     # 如果用户输入了参数，args会包含这些值
     # 如果用户没有输入，会使用默认值
     args = parser.parse_args()
+    if args.num_variations < 1:
+        parser.error("--num-variations 必须至少为1")
+    if args.guidance_scale is not None and not math.isfinite(args.guidance_scale):
+        parser.error("--guidance-scale 必须是有限的数")
+    if args.guidance_steps is not None and args.guidance_steps < 0:
+        parser.error("--guidance-steps 不能为负数")
     
     # 获取最优的计算设备
     # get_optimal_device() 会返回一个元组：(device, device_name)
     device, device_name = get_optimal_device()
     print(f"使用设备: {device_name}")
     
+    # 确定引导参数：--no-guidance 优先，其次是 --guidance-steps，最后是 --fast
+    guidance_scale = 1.0 if args.no_guidance else args.guidance_scale
+    guidance_steps = args.guidance_steps
+    if guidance_steps is None and args.fast:
+        guidance_steps = FAST_GUIDANCE_STEPS
+    
     # 创建音乐生成器实例
     # MusicGen类是我们自定义的类，封装了模型的所有功能
-    generator = MusicGen(model_size=args.model, device=device)
+    generator = MusicGen(model_size=args.model, device=device, compile=args.compile)
+    
+    # 根据参数创建后处理器（MusicGen的采样率为32000Hz）
+    postprocessor = None
+    if args.postprocess:
+        postprocessor = AudioPostProcessor(
+            sample_rate=32000,
+            target_rate=args.sample_rate,
+            normalize=args.normalize,
+            target_db=args.target_db,
+            fade_in=args.fade_in,
+            fade_out=args.fade_out,
+        )
     
     # 执行音乐生成
     # generate() 方法会：
@@ -91,11 +216,20 @@ def main():
     # 2. 处理文本输入
     # 3. 生成音频
     # 4. 保存为WAV文件
-    generator.generate(
-        prompt=args.prompt,        # 音乐描述
+    options = dict(
         max_tokens=args.max_tokens,  # 最大token数
-        output_path=args.output    # 输出文件路径
+        output_path=args.output,   # 输出文件路径
+        postprocessor=postprocessor,  # 音频后处理器
+        num_variations=args.num_variations,  # 变体数量
+        seed=args.seed,  # 随机种子
+        guidance_scale=guidance_scale,  # 引导系数
+        guidance_steps=guidance_steps  # 引导步数
     )
+    if args.continue_from:
+        # 续写：先把开头编码为音频token，再接着生成
+        generator.generate_continuation(args.continue_from, args.prompt, **options)
+    else:
+        generator.generate(prompt=args.prompt, **options)
 
 # 这是Python的特殊语法，表示"如果直接运行这个文件"
 # 当用户执行 "python main.py" 时，这个条件为True
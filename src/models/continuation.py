@@ -0,0 +1,187 @@
+"""
+音频续写模块
+
+续写时先用EnCodec把已有的音频编码为音频token，再接着这些token生成后面的部分。
+同一段音频经常被反复续写（例如同一段前奏接不同的后续），所以编码结果按文件内容的哈希缓存：
+第二次续写同一段音频时完全跳过编码。
+
+这个模块提供：
+1. AudioPrompt: 续写的开头（读取WAV、计算内容哈希）
+2. AudioCodeCache: 音频token的LRU缓存，记录命中次数和节省的编码时间
+
+使用示例:
+    prompt = AudioPrompt.from_file("intro.wav")
+    engine.generate_continuation(prompt, "A calm piano melody", output_path="continued.wav")
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入必要的库
+import collections  # 有序字典，用于LRU缓存
+import hashlib  # 计算文件内容的哈希
+import io  # 从内存中读取WAV
+import math  # 用于计算帧数
+import struct  # WAV头部不完整时scipy抛出struct.error
+import threading  # 缓存在多个线程中共享
+
+import numpy as np  # 音频数据
+import scipy.io.wavfile  # 读取WAV文件
+
+# 默认最多缓存的开头数量（small模型30秒音频的token只有约50KB，主要是限制条目数）
+MAX_CACHED_PROMPTS = 64
+
+
+class AudioPrompt:
+    """
+    续写的开头：一段已有的音频
+
+    属性:
+        audio (np.ndarray): float32音频，形状为 (channels, samples)，取值范围[-1, 1]
+        sampling_rate (int): 采样率
+        key (str): 文件内容的SHA-256哈希，用作音频token缓存的键
+    """
+
+    def __init__(self, audio, sampling_rate, key):
+        self.audio = audio
+        self.sampling_rate = sampling_rate
+        self.key = key
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        从WAV文件的内容创建
+
+        参数:
+            data (bytes): WAV文件的内容
+
+        返回值:
+            AudioPrompt: 续写的开头
+
+        异常:
+            ValueError: 不是有效的WAV文件，或者音频为空
+        """
+        key = hashlib.sha256(data).hexdigest()
+        try:
+            sampling_rate, audio = scipy.io.wavfile.read(io.BytesIO(data))
+        except (struct.error, EOFError) as e:
+            raise ValueError(f"不是有效的WAV文件: {e}")
+        audio = _to_float(audio)
+        # scipy返回 (samples,) 或 (samples, channels)，统一为 (channels, samples)
+        audio = audio[None, :] if audio.ndim == 1 else audio.T
+        if audio.shape[-1] == 0:
+            raise ValueError("音频为空")
+        return cls(np.ascontiguousarray(audio), sampling_rate, key)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        从WAV文件创建
+
+        参数:
+            path (str): WAV文件路径
+        """
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    @property
+    def duration(self):
+        """音频时长（秒）"""
+        return self.audio.shape[-1] / self.sampling_rate
+
+    def frames(self, frame_rate):
+        """编码后的音频token帧数"""
+        return math.ceil(self.duration * frame_rate)
+
+
+def _to_float(audio):
+    """把WAV中的整数采样转换为[-1, 1]范围的float32"""
+    if audio.dtype == np.uint8:
+        return (audio.astype(np.float32) - 128.0) / 128.0
+    if np.issubdtype(audio.dtype, np.integer):
+        return audio.astype(np.float32) / float(np.iinfo(audio.dtype).max)
+    return audio.astype(np.float32)
+
+
+class AudioCodeCache:
+    """
+    音频token的LRU缓存（线程安全）
+
+    键是文件内容的哈希，值是编码后的音频token（保存在CPU上）和当时的编码耗时，
+    命中时"节省的时间"就是这次编码原本需要的时间。
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_PROMPTS):
+        """
+        参数:
+            max_entries (int): 最多缓存的条目数，超出时丢弃最久没有使用的条目
+        """
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "saved_time": 0.0}
+
+    def get(self, key):
+        """
+        查找缓存
+
+        参数:
+            key (str): 文件内容的哈希
+
+        返回值:
+            dict: {audio_codes, encode_time}，没有缓存时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            self._stats["saved_time"] += entry["encode_time"]
+            return entry
+
+    def put(self, key, audio_codes, encode_time):
+        """
+        保存编码结果
+
+        参数:
+            key (str): 文件内容的哈希
+            audio_codes (torch.LongTensor): 编码后的音频token
+            encode_time (float): 编码耗时（秒）
+        """
+        with self._lock:
+            self._entries[key] = {"audio_codes": audio_codes.cpu(), "encode_time": encode_time}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        返回值:
+            dict: entries（当前条目数）、hits、misses、saved_time（命中节省的编码时间，秒）
+        """
+        with self._lock:
+            return {"entries": len(self._entries), **self._stats}
+
+
+# 如果直接运行这个文件，会执行以下测试代码
+if __name__ == "__main__":
+    import time
+
+    import torch
+
+    print("🧪 测试音频开头和音频token缓存...")
+    buffer = io.BytesIO()
+    t = np.arange(32000) / 32000
+    scipy.io.wavfile.write(buffer, 32000, (0.5 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16))
+    prompt = AudioPrompt.from_bytes(buffer.getvalue())
+    print(f"时长: {prompt.duration:.2f}秒, 帧数: {prompt.frames(50)}, 哈希: {prompt.key[:12]}...")
+
+    cache = AudioCodeCache(max_entries=2)
+    assert cache.get(prompt.key) is None
+    cache.put(prompt.key, torch.zeros(1, 4, prompt.frames(50), dtype=torch.long), encode_time=0.25)
+    start = time.perf_counter()
+    assert cache.get(prompt.key) is not None
+    print(f"缓存命中耗时: {(time.perf_counter() - start) * 1000:.3f}ms, 统计: {cache.stats()}")
+    print("🎉 测试通过!")
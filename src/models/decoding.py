@@ -0,0 +1,532 @@
+"""
+MusicGen解码循环模块
+
+这个模块把MusicGen的生成过程拆成三个独立的步骤：
+1. encode_text: 文本编码（每个提示词只编码一次）
+2. sample_audio_codes: 自回归地生成音频token（audio codes），可以接在一段已有音频的token后面续写
+3. decode_audio_codes: 用EnCodec把音频token解码为波形
+
+续写时用 encode_audio_codes 把已有音频编码为音频token（与 decode_audio_codes 互逆）。
+
+和直接调用 model.generate() 相比，自己控制解码循环可以：
+- 把同一个提示词的编码结果复制到整个batch，一次前向生成多个变体
+- 给batch中的每一行使用独立的随机种子，每个变体都可以单独复现
+- 使用预分配的静态KV缓存，并用 torch.compile 编译单步解码（DecoderStep）
+- 只在前K步使用无分类器引导，之后丢弃无条件分支，剩下的步骤batch减半
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入必要的库
+import os  # 用于处理缓存目录
+import time  # 用于统计单步耗时
+
+import torch  # PyTorch深度学习框架
+from transformers import DynamicCache, EncoderDecoderCache, StaticCache  # KV缓存
+
+# 编译模式下，静态KV缓存的长度按这个粒度向上取整，
+# 这样不同的max_tokens可以复用同一份编译结果，而不是每次都重新编译
+CACHE_LENGTH_BUCKET = 256
+
+# 编译模式下，文本编码的长度也按这个粒度补齐（补齐的位置被注意力掩码屏蔽），
+# 避免不同长度的提示词触发重新编译
+ENCODER_LENGTH_BUCKET = 64
+
+# 快速档位只在前这么多步使用无分类器引导：引导主要影响开头的风格和结构，
+# 之后batch减半。256个token时理论计算量约为完整引导的0.56倍，实际节省取决于硬件（见README中的实测）
+FAST_GUIDANCE_STEPS = 32
+
+# 编译产物的默认缓存目录，重启后可以直接复用，不需要重新编译
+DEFAULT_COMPILE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "local-ai-music-app", "compile")
+
+
+def encode_text(model, processor, prompts, device, num_variations=1):
+    """
+    编码文本提示词
+
+    参数:
+        model (MusicgenForConditionalGeneration): 已加载的模型
+        processor (AutoProcessor): 文本处理器
+        prompts (list[str]): 提示词列表
+        device (torch.device): 计算设备
+        num_variations (int): 每个提示词需要生成的变体数量
+
+    返回值:
+        tuple: (encoder_hidden_states, encoder_attention_mask)
+            形状分别为 (batch, seq_len, hidden) 和 (batch, seq_len)，
+            其中 batch = len(prompts) * num_variations
+    """
+    inputs = processor(text=prompts, padding=True, return_tensors="pt").to(device)
+
+    # 每个提示词只运行一次文本编码器
+    hidden_states = model.text_encoder(
+        input_ids=inputs["input_ids"],
+        attention_mask=inputs["attention_mask"],
+    ).last_hidden_state
+
+    # 与模型forward保持一致：需要时把文本编码投影到解码器的维度，并屏蔽padding位置
+    if (
+        model.text_encoder.config.hidden_size != model.decoder.config.hidden_size
+        and model.decoder.config.cross_attention_hidden_size is None
+    ):
+        hidden_states = model.enc_to_dec_proj(hidden_states)
+    attention_mask = inputs["attention_mask"]
+    hidden_states = hidden_states * attention_mask[..., None]
+
+    # 把编码结果复制给每个变体（不需要重新编码）
+    if num_variations > 1:
+        hidden_states = hidden_states.repeat_interleave(num_variations, dim=0)
+        attention_mask = attention_mask.repeat_interleave(num_variations, dim=0)
+
+    return hidden_states, attention_mask
+
+
+def make_generators(seeds, device):
+    """
+    为每个随机种子创建一个独立的随机数生成器
+
+    参数:
+        seeds (list[int]): 每一行的随机种子
+        device (torch.device): 计算设备
+
+    返回值:
+        list[torch.Generator]: 随机数生成器列表
+    """
+    return [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+
+
+def _sample_next_tokens(logits, generators, num_codebooks, top_k, temperature):
+    """
+    从logits中采样下一个token
+
+    每一行（一个变体的所有码本）使用自己的随机数生成器，
+    所以同一个种子无论和谁放在一个batch里，都会得到相同的结果。
+    """
+    if temperature is not None and temperature != 1.0:
+        logits = logits / temperature
+
+    # top-k：只保留概率最高的k个token
+    if top_k:
+        top_k = min(top_k, logits.shape[-1])
+        kth = torch.topk(logits, top_k, dim=-1).values[..., -1:]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+
+    probs = torch.softmax(logits.float(), dim=-1)
+    rows = probs.split(num_codebooks, dim=0)
+    samples = [torch.multinomial(row, 1, generator=generator) for row, generator in zip(rows, generators)]
+    return torch.cat(samples, dim=0).squeeze(1)
+
+
+class DecoderStep:
+    """
+    单步解码器
+
+    每调用一次，解码器前进一步（输入上一步的token，输出下一步的logits）。
+    - eager模式: 使用动态增长的KV缓存，和 model.generate() 行为一致
+    - 编译模式: 预分配长度固定的静态KV缓存，并用 torch.compile 编译单步解码，
+      省去每一步的Python调度和缓存重新分配的开销；编译失败时自动回退到eager模式
+
+    使用示例:
+        step = DecoderStep(model, compile=True)
+        cache = step.new_cache(max_length=257, encoder_length=12)
+        logits = step(input_ids, encoder_hidden_states, encoder_attention_mask, cache, prefill=True)
+    """
+
+    def __init__(self, model, compile=False, cache_dir=None):
+        """
+        初始化单步解码器
+
+        参数:
+            model (MusicgenForConditionalGeneration): 已加载的模型
+            compile (bool): 是否使用静态KV缓存 + torch.compile
+            cache_dir (str, 可选): 编译产物的缓存目录，默认 ~/.cache/local-ai-music-app/compile
+        """
+        self.model = model
+        self.compiled = None
+        self.cache_dir = cache_dir or DEFAULT_COMPILE_CACHE_DIR
+        self._compiled_shapes = set()
+        # 记录每一步的耗时（秒），用于基准测试
+        self.step_times = []
+        self.record_times = False
+
+        if compile:
+            self._setup_compile()
+
+    @property
+    def is_compiled(self):
+        """当前是否在使用编译后的单步解码"""
+        return self.compiled is not None
+
+    def _setup_compile(self):
+        """准备编译：加载上次保存的编译产物，然后包装单步解码函数"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # 编译产物（Inductor生成的内核等）打包保存在缓存目录中，
+        # 重启后加载它们，首次编译的耗时可以大幅缩短
+        artifacts_path = os.path.join(self.cache_dir, "artifacts.bin")
+        if os.path.exists(artifacts_path) and hasattr(torch.compiler, "load_cache_artifacts"):
+            try:
+                with open(artifacts_path, "rb") as f:
+                    torch.compiler.load_cache_artifacts(f.read())
+                print(f"📦 已加载编译缓存: {artifacts_path}")
+            except Exception as e:
+                print(f"⚠️ 编译缓存加载失败，将重新编译: {e}")
+
+        # GPU上使用CUDA Graph进一步减少每一步的启动开销
+        mode = "reduce-overhead" if self.model.device.type == "cuda" else None
+        try:
+            self.compiled = torch.compile(self._forward, mode=mode, dynamic=False)
+        except Exception as e:
+            print(f"⚠️ torch.compile不可用，使用eager模式: {e}")
+            self.compiled = None
+
+    def _save_artifacts(self):
+        """把编译产物保存到缓存目录，下次启动时直接加载"""
+        if not hasattr(torch.compiler, "save_cache_artifacts"):
+            return
+        try:
+            artifacts = torch.compiler.save_cache_artifacts()
+            if artifacts is not None:
+                with open(os.path.join(self.cache_dir, "artifacts.bin"), "wb") as f:
+                    f.write(artifacts[0])
+        except Exception as e:
+            print(f"⚠️ 编译缓存保存失败: {e}")
+
+    def new_cache(self, max_length, encoder_length):
+        """
+        创建一次生成所需的KV缓存
+
+        参数:
+            max_length (int): 解码器最多处理的token数（起始token + 生成的token）
+            encoder_length (int): 文本编码的长度（交叉注意力缓存的长度）
+
+        返回值:
+            EncoderDecoderCache: 自注意力缓存 + 交叉注意力缓存
+        """
+        config = self.model.decoder.config
+        if not self.is_compiled:
+            return EncoderDecoderCache(DynamicCache(config=config), DynamicCache(config=config))
+
+        # 静态缓存一次性按最大长度分配好，解码过程中只做原地写入
+        max_length = -(-max_length // CACHE_LENGTH_BUCKET) * CACHE_LENGTH_BUCKET
+        return EncoderDecoderCache(
+            StaticCache(config=config, max_cache_len=max_length),
+            StaticCache(config=config, max_cache_len=encoder_length),
+        )
+
+    def drop_unconditional(self, past_key_values, batch_size):
+        """
+        从KV缓存中丢弃无条件分支（batch的后半部分）
+
+        参数:
+            past_key_values (EncoderDecoderCache): 当前的KV缓存
+            batch_size (int): 保留的行数（有条件分支的batch大小）
+        """
+        indices = torch.arange(batch_size, device=self.model.device)
+        past_key_values.reorder_cache(indices)
+
+        # 静态缓存被替换成了新的张量，需要重新标记为固定地址，编译后的图才能继续使用
+        if self.is_compiled:
+            for cache in (past_key_values.self_attention_cache, past_key_values.cross_attention_cache):
+                for layer in cache.layers:
+                    if layer.keys is not None:
+                        torch._dynamo.mark_static_address(layer.keys)
+                        torch._dynamo.mark_static_address(layer.values)
+
+    def pad_encoder_states(self, encoder_hidden_states, encoder_attention_mask):
+        """
+        编译模式下把文本编码补齐到固定粒度的长度
+
+        补齐的位置注意力掩码为0，不影响生成结果；eager模式下原样返回。
+        """
+        if not self.is_compiled:
+            return encoder_hidden_states, encoder_attention_mask
+
+        length = encoder_hidden_states.shape[1]
+        padding = -(-length // ENCODER_LENGTH_BUCKET) * ENCODER_LENGTH_BUCKET - length
+        if padding == 0:
+            return encoder_hidden_states, encoder_attention_mask
+        encoder_hidden_states = torch.nn.functional.pad(encoder_hidden_states, (0, 0, 0, padding))
+        encoder_attention_mask = torch.nn.functional.pad(encoder_attention_mask, (0, padding))
+        return encoder_hidden_states, encoder_attention_mask
+
+    def _forward(self, input_ids, encoder_hidden_states, encoder_attention_mask, past_key_values):
+        return self.model.decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+        ).logits
+
+    def __call__(self, input_ids, encoder_hidden_states, encoder_attention_mask, past_key_values, prefill=False):
+        """
+        执行一步解码
+
+        参数:
+            input_ids (torch.LongTensor): 本步的输入token
+            encoder_hidden_states (torch.Tensor): 文本编码
+            encoder_attention_mask (torch.Tensor): 文本注意力掩码
+            past_key_values (EncoderDecoderCache): new_cache() 创建的KV缓存
+            prefill (bool): 是否为第一步；第一步要写入交叉注意力缓存，始终用eager执行
+
+        返回值:
+            torch.Tensor: 本步的logits
+        """
+        start_time = time.perf_counter() if self.record_times else None
+        args = (input_ids, encoder_hidden_states, encoder_attention_mask, past_key_values)
+
+        if prefill or not self.is_compiled:
+            logits = self._forward(*args)
+        else:
+            shape = tuple(input_ids.shape)
+            try:
+                logits = self.compiled(*args)
+            except Exception as e:
+                # 编译失败不影响生成：回退到eager模式继续
+                print(f"⚠️ 编译后的解码步骤执行失败，回退到eager模式: {e}")
+                self.compiled = None
+                logits = self._forward(*args)
+            else:
+                if shape not in self._compiled_shapes:
+                    self._compiled_shapes.add(shape)
+                    self._save_artifacts()
+
+        if self.record_times:
+            if logits.device.type == "cuda":
+                torch.cuda.synchronize(logits.device)
+            self.step_times.append(time.perf_counter() - start_time)
+        return logits
+
+
+def sample_audio_codes(
+    model,
+    encoder_hidden_states,
+    encoder_attention_mask,
+    max_new_tokens,
+    generators,
+    guidance_scale=None,
+    guidance_steps=None,
+    top_k=None,
+    temperature=None,
+    decoder_step=None,
+    audio_prompt_codes=None,
+):
+    """
+    自回归生成音频token
+
+    参数:
+        model (MusicgenForConditionalGeneration): 已加载的模型
+        encoder_hidden_states (torch.Tensor): encode_text() 返回的文本编码
+        encoder_attention_mask (torch.Tensor): encode_text() 返回的注意力掩码
+        max_new_tokens (int): 生成的token数
+        generators (list[torch.Generator]): 每一行的随机数生成器
+        guidance_scale (float, 可选): 无分类器引导系数，默认使用模型的生成配置；
+            小于等于1表示不使用引导，每一步的计算量减半
+        guidance_steps (int, 可选): 只在前K步使用引导，之后丢弃无条件分支；None表示每一步都使用
+        top_k (int, 可选): top-k采样，默认使用模型的生成配置
+        temperature (float, 可选): 采样温度，默认使用模型的生成配置
+        decoder_step (DecoderStep, 可选): 单步解码器，默认使用eager模式
+        audio_prompt_codes (torch.LongTensor, 可选): 续写的开头，encode_audio_codes() 返回的音频token，
+            形状为 (batch, num_codebooks, prompt_frames)；第一步一次性处理完整的开头
+
+    返回值:
+        torch.LongTensor: 音频token，形状为 (batch, num_codebooks, frames)；
+            续写时包含开头的 prompt_frames 帧，之后是新生成的帧
+    """
+    decoder = model.decoder
+    generation_config = model.generation_config
+    pad_token_id = generation_config.pad_token_id
+    num_codebooks = decoder.num_codebooks
+    batch_size = encoder_hidden_states.shape[0]
+    device = encoder_hidden_states.device
+
+    # 没有指定的参数使用模型自带的生成配置（MusicGen默认: guidance 3.0, top-k 250）
+    guidance_scale = guidance_scale if guidance_scale is not None else generation_config.guidance_scale
+    top_k = top_k if top_k is not None else generation_config.top_k
+    temperature = temperature if temperature is not None else generation_config.temperature
+    use_guidance = guidance_scale is not None and guidance_scale > 1 and guidance_steps != 0
+
+    # 无分类器引导：在batch后半部分追加"无条件"输入（全零的文本编码）
+    if use_guidance:
+        encoder_hidden_states = torch.cat([encoder_hidden_states, torch.zeros_like(encoder_hidden_states)], dim=0)
+        encoder_attention_mask = torch.cat([encoder_attention_mask, torch.zeros_like(encoder_attention_mask)], dim=0)
+
+    # 起始token，并构建MusicGen的"延迟模式"掩码（每个码本比上一个晚一步）
+    input_ids = torch.full(
+        (batch_size * num_codebooks, 1),
+        generation_config.decoder_start_token_id,
+        dtype=torch.long,
+        device=device,
+    )
+    # 续写：开头的音频token接在起始token后面，延迟模式掩码会把它们按码本错开，
+    # 返回的input_ids截止到第一个需要预测的位置
+    if audio_prompt_codes is not None:
+        input_ids = torch.cat([input_ids, audio_prompt_codes.reshape(batch_size * num_codebooks, -1)], dim=-1)
+    input_ids, delay_pattern_mask = decoder.build_delay_pattern_mask(
+        input_ids,
+        pad_token_id=pad_token_id,
+        max_length=input_ids.shape[-1] + max_new_tokens,
+    )
+
+    if decoder_step is None:
+        decoder_step = DecoderStep(model)
+    encoder_hidden_states, encoder_attention_mask = decoder_step.pad_encoder_states(
+        encoder_hidden_states, encoder_attention_mask
+    )
+    past_key_values = decoder_step.new_cache(
+        max_length=input_ids.shape[-1] + max_new_tokens,
+        encoder_length=encoder_hidden_states.shape[1],
+    )
+
+    for step in range(max_new_tokens):
+        # 引导只用于前 guidance_steps 步：之后丢弃无条件分支，batch减半
+        if use_guidance and step == guidance_steps:
+            use_guidance = False
+            encoder_hidden_states = encoder_hidden_states[:batch_size]
+            encoder_attention_mask = encoder_attention_mask[:batch_size]
+            decoder_step.drop_unconditional(past_key_values, batch_size)
+
+        step_ids = decoder.apply_delay_pattern_mask(input_ids, delay_pattern_mask)
+        # 第一步之后KV缓存里已经有历史信息，只需要输入最后一个token
+        if step > 0:
+            # 保持连续内存，否则stride随序列长度变化，编译模式下每一步都会重新编译
+            step_ids = step_ids[:, -1:].contiguous()
+        if use_guidance:
+            step_ids = step_ids.repeat((2, 1))
+
+        logits = decoder_step(
+            step_ids,
+            encoder_hidden_states,
+            encoder_attention_mask,
+            past_key_values,
+            prefill=step == 0,
+        )[:, -1, :]
+
+        # 合并有条件和无条件的预测
+        if use_guidance:
+            conditional, unconditional = logits.split(batch_size * num_codebooks, dim=0)
+            logits = unconditional + (conditional - unconditional) * guidance_scale
+
+        next_tokens = _sample_next_tokens(logits, generators, num_codebooks, top_k, temperature)
+        input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+
+    # 应用延迟模式掩码，并去掉padding token，恢复为对齐的音频token
+    output_ids = decoder.apply_delay_pattern_mask(input_ids, delay_pattern_mask)
+    output_ids = output_ids[output_ids != pad_token_id].reshape(batch_size, num_codebooks, -1)
+    return output_ids
+
+
+def score_audio_codes(model, encoder_hidden_states, encoder_attention_mask, audio_codes, guidance_scale=None):
+    """
+    计算音频token在完整引导下的平均对数概率，作为生成质量的参考指标
+
+    用一次teacher forcing前向计算每个token在"每一步都使用引导"时的对数概率。
+    同一个提示词下，数值越接近完整引导生成的结果，说明省略引导带来的质量损失越小。
+
+    参数:
+        model (MusicgenForConditionalGeneration): 已加载的模型
+        encoder_hidden_states (torch.Tensor): encode_text() 返回的文本编码
+        encoder_attention_mask (torch.Tensor): encode_text() 返回的注意力掩码
+        audio_codes (torch.LongTensor): sample_audio_codes() 返回的音频token
+        guidance_scale (float, 可选): 无分类器引导系数，默认使用模型的生成配置
+
+    返回值:
+        torch.Tensor: 每一行的平均对数概率，形状为 (batch,)
+    """
+    decoder = model.decoder
+    generation_config = model.generation_config
+    pad_token_id = generation_config.pad_token_id
+    batch_size, num_codebooks, frames = audio_codes.shape
+    guidance_scale = guidance_scale if guidance_scale is not None else generation_config.guidance_scale
+    use_guidance = guidance_scale is not None and guidance_scale > 1
+
+    # 按延迟模式重建生成时的完整输入序列：掩码为-1的位置依次填入音频token
+    input_ids = torch.full(
+        (batch_size * num_codebooks, 1),
+        generation_config.decoder_start_token_id,
+        dtype=torch.long,
+        device=audio_codes.device,
+    )
+    _, delay_pattern_mask = decoder.build_delay_pattern_mask(
+        input_ids,
+        pad_token_id=pad_token_id,
+        max_length=frames + num_codebooks,
+    )
+    free = delay_pattern_mask == -1
+    sequence = delay_pattern_mask.clone()
+    sequence[free] = audio_codes.reshape(-1)
+
+    inputs = sequence[:, :-1]
+    if use_guidance:
+        encoder_hidden_states = torch.cat([encoder_hidden_states, torch.zeros_like(encoder_hidden_states)], dim=0)
+        encoder_attention_mask = torch.cat([encoder_attention_mask, torch.zeros_like(encoder_attention_mask)], dim=0)
+        inputs = inputs.repeat((2, 1))
+
+    logits = decoder(
+        input_ids=inputs,
+        encoder_hidden_states=encoder_hidden_states,
+        encoder_attention_mask=encoder_attention_mask,
+        use_cache=False,
+    ).logits
+    if use_guidance:
+        conditional, unconditional = logits.split(batch_size * num_codebooks, dim=0)
+        logits = unconditional + (conditional - unconditional) * guidance_scale
+
+    # 只统计真正的音频token（跳过延迟模式中的起始token和padding）
+    log_probs = torch.log_softmax(logits.float(), dim=-1)
+    targets = sequence[:, 1:].masked_fill(~free[:, 1:], 0)
+    token_log_probs = log_probs.gather(-1, targets[..., None])[..., 0]
+    token_log_probs = token_log_probs.masked_fill(~free[:, 1:], 0.0)
+    token_log_probs = token_log_probs.reshape(batch_size, -1)
+    return token_log_probs.sum(dim=-1) / (num_codebooks * frames)
+
+
+def encode_audio_codes(model, audio_values):
+    """
+    用EnCodec把音频波形编码为音频token（decode_audio_codes 的逆过程）
+
+    参数:
+        model (MusicgenForConditionalGeneration): 已加载的模型
+        audio_values (torch.Tensor): 形状为 (batch, channels, samples) 的音频波形，
+            采样率和声道数必须与模型一致
+
+    返回值:
+        torch.LongTensor: 形状为 (batch, num_codebooks, frames) 的音频token
+    """
+    if model.decoder.config.audio_channels == 1:
+        # EnCodec输出的形状为 (frames=1, batch, codebooks, seq_len)
+        return model.audio_encoder.encode(audio_values).audio_codes[0]
+
+    # 立体声：左右声道分别编码，码本交错排列
+    left = model.audio_encoder.encode(audio_values[:, :1]).audio_codes[0]
+    right = model.audio_encoder.encode(audio_values[:, 1:]).audio_codes[0]
+    audio_codes = left.new_empty((left.shape[0], 2 * left.shape[1], left.shape[2]))
+    audio_codes[:, ::2] = left
+    audio_codes[:, 1::2] = right
+    return audio_codes
+
+
+def decode_audio_codes(model, audio_codes):
+    """
+    把音频token解码为波形
+
+    参数:
+        model (MusicgenForConditionalGeneration): 已加载的模型
+        audio_codes (torch.LongTensor): 形状为 (batch, num_codebooks, frames) 的音频token
+
+    返回值:
+        torch.Tensor: 形状为 (batch, channels, samples) 的音频波形
+    """
+    # EnCodec需要额外的frame维度: (frames=1, batch, codebooks, seq_len)
+    audio_codes = audio_codes[None, ...]
+    audio_scales = [None] * audio_codes.shape[1]
+
+    if model.decoder.config.audio_channels == 1:
+        return model.audio_encoder.decode(audio_codes, audio_scales=audio_scales).audio_values
+
+    # 立体声：左右声道的码本交错排列，分别解码后再拼接
+    left = model.audio_encoder.decode(audio_codes[:, :, ::2, :], audio_scales=audio_scales).audio_values
+    right = model.audio_encoder.decode(audio_codes[:, :, 1::2, :], audio_scales=audio_scales).audio_values
+    return torch.cat([left, right], dim=1)
@@ -0,0 +1,459 @@
+"""
+内存估算与统计模块
+
+这个模块负责生成过程中的内存管理：
+1. estimate_generation_memory: 根据模型结构、batch大小和token数，预估KV缓存、激活值和音频解码的内存
+2. MemoryTracker: 统计一段代码执行期间的峰值RSS（进程常驻内存）和张量内存（CUDA/MPS）
+3. release_memory: 请求结束后显式释放缓存，让内存回到基线；freeze_baseline: 模型加载后冻结已有对象，
+   让每个请求之后的完整垃圾回收只扫描新对象
+4. MemoryGuard: 内存预算守卫，超出预算的请求被拒绝或拆分，并发请求按预算排队
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入必要的库
+import contextlib  # 用于实现预留内存的上下文管理器
+import ctypes  # 用于调用glibc的malloc_trim
+import gc  # 垃圾回收
+import os  # 用于读取/proc
+import sys  # 用于判断操作系统
+import threading  # 后台采样线程和预算的条件变量
+import time  # 用于统计等待时间
+
+import torch  # PyTorch深度学习框架
+
+# psutil是可选依赖：没有安装时在Linux上读取/proc，其他系统退化为进程历史峰值
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# 超出预算时的处理方式
+#   split: 把多个变体拆成几批依次生成（每批都在预算内），单个变体也超出预算时拒绝
+#   reject: 直接拒绝
+MEMORY_POLICIES = ("split", "reject")
+
+# 各模型的结构参数（与Hugging Face上的facebook/musicgen-*一致），模型加载前用于估算
+MODEL_SHAPES = {
+    "small": dict(
+        hidden_size=1024, num_hidden_layers=24, num_attention_heads=16, ffn_dim=4096,
+        num_codebooks=4, vocab_size=2048, audio_channels=1,
+        sampling_rate=32000, frame_rate=50, num_filters=64,
+    ),
+    "medium": dict(
+        hidden_size=1536, num_hidden_layers=48, num_attention_heads=24, ffn_dim=6144,
+        num_codebooks=4, vocab_size=2048, audio_channels=1,
+        sampling_rate=32000, frame_rate=50, num_filters=64,
+    ),
+}
+
+# 文本编码的估算长度（普通提示词远短于这个长度）
+ENCODER_LENGTH = 64
+
+# EnCodec解码时的激活值相对于"最后一层特征图"的倍数（实测值，卷积和残差块的中间结果）
+DECODE_ACTIVATION_FACTOR = 6
+
+# 与batch和长度无关的固定开销（实测值：分配器的内存池、第一次调用时创建的缓冲区等）
+TOKEN_OVERHEAD = 32 * MB
+DECODE_OVERHEAD = 64 * MB
+
+# 每一步解码时logits相关的张量份数（logits、引导合并、top-k、softmax）
+LOGITS_COPIES = 4
+
+# 续写时开头的KV缓存额外占用的份数（实测值）：动态缓存每一步都重新分配更长的张量，
+# 开头越长，分配器中留下的空洞越大
+PREFILL_KV_COPIES = 1
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """请求的预估内存超出了预算"""
+
+
+def model_shape(config):
+    """
+    从已加载模型的配置中提取估算内存需要的结构参数
+
+    参数:
+        config (MusicgenConfig): 模型配置
+
+    返回值:
+        dict: 与 MODEL_SHAPES 中的条目格式相同
+    """
+    decoder = config.decoder
+    audio_encoder = config.audio_encoder
+    return dict(
+        hidden_size=decoder.hidden_size,
+        num_hidden_layers=decoder.num_hidden_layers,
+        num_attention_heads=decoder.num_attention_heads,
+        ffn_dim=decoder.ffn_dim,
+        num_codebooks=decoder.num_codebooks,
+        vocab_size=decoder.vocab_size,
+        audio_channels=decoder.audio_channels,
+        sampling_rate=audio_encoder.sampling_rate,
+        frame_rate=audio_encoder.frame_rate,
+        num_filters=audio_encoder.num_filters,
+    )
+
+
+def estimate_generation_memory(
+    shape,
+    batch_size,
+    max_tokens,
+    guidance=True,
+    guidance_steps=None,
+    encoder_length=ENCODER_LENGTH,
+    dtype_bytes=4,
+    static_cache_length=None,
+    prompt_frames=0,
+):
+    """
+    预估一次生成的内存需求（不含模型权重）
+
+    参数:
+        shape (dict): 模型结构参数，见 MODEL_SHAPES / model_shape()
+        batch_size (int): 变体数量
+        max_tokens (int): 生成的token数（续写时包含开头的帧数）
+        guidance (bool): 是否使用无分类器引导（引导时batch翻倍）
+        guidance_steps (int, 可选): 只在前K步使用引导
+        encoder_length (int): 文本编码长度
+        dtype_bytes (int): 模型参数每个元素的字节数（float32为4）
+        static_cache_length (int, 可选): 编译模式下静态KV缓存的长度
+        prompt_frames (int): 续写时开头的帧数，第一步一次性送进解码器（预填充）
+
+    返回值:
+        dict: 各部分的字节数
+            - kv_cache: 自注意力和交叉注意力的KV缓存
+            - activations: 单步解码的激活值和logits
+            - prefill: 续写第一步预填充整个开头时的激活值，不续写时为0
+            - tokens: token阶段的峰值（kv_cache + activations + prefill + 固定开销）
+            - decode: 音频解码阶段的峰值
+            - peak: 两个阶段中较大的一个
+    """
+    hidden = shape["hidden_size"]
+    layers = shape["num_hidden_layers"]
+    codebooks = shape["num_codebooks"]
+    guided_steps = 0
+    if guidance:
+        guided_steps = max_tokens if guidance_steps is None else min(guidance_steps, max_tokens)
+    rows = batch_size * (2 if guided_steps else 1)
+
+    # 每个token在所有层中的K和V
+    per_token = 2 * layers * hidden * dtype_bytes
+    if static_cache_length is not None:
+        # 静态缓存一开始就按最大长度分配
+        self_attention = rows * static_cache_length * per_token
+    else:
+        # 动态缓存逐步增长：引导阶段结束时batch为2倍，之后batch减半继续增长到最终长度
+        length = max_tokens + 1
+        self_attention = max(rows * (guided_steps + 1), batch_size * length) * per_token
+    cross_attention = rows * encoder_length * per_token
+    kv_cache = self_attention + cross_attention
+
+    # 单步激活值：每一层的隐藏状态和FFN中间结果，以及所有码本的logits（float32）
+    length = static_cache_length or max_tokens + 1
+    layer_activations = rows * (4 * hidden + shape["ffn_dim"] + shape["num_attention_heads"] * length) * dtype_bytes
+    logits = rows * codebooks * shape["vocab_size"] * 4 * LOGITS_COPIES
+    activations = layer_activations + logits
+
+    # 续写的预填充：开头的P帧一次经过解码器，每一层都有 (heads, P, P) 的注意力分数、
+    # 所有位置的隐藏状态和FFN中间结果，最后还有所有位置、所有码本的logits
+    prefill = 0
+    if prompt_frames:
+        attention = shape["num_attention_heads"] * prompt_frames * prompt_frames
+        prefill = rows * (attention + prompt_frames * (4 * hidden + shape["ffn_dim"])) * dtype_bytes
+        prefill += rows * codebooks * prompt_frames * shape["vocab_size"] * 4
+        prefill += rows * prompt_frames * per_token * PREFILL_KV_COPIES
+
+    # 音频解码：最后一层特征图 (num_filters, samples) 的若干倍，再加上输出的波形和numpy副本
+    frames = max(max_tokens - codebooks + 1, 1)
+    samples = frames * shape["sampling_rate"] // shape["frame_rate"]
+    decode = DECODE_OVERHEAD + batch_size * samples * (
+        shape["num_filters"] * dtype_bytes * DECODE_ACTIVATION_FACTOR + shape["audio_channels"] * 4 * 2
+    )
+
+    tokens = TOKEN_OVERHEAD + kv_cache + activations + prefill
+    return {
+        "kv_cache": kv_cache,
+        "activations": activations,
+        "prefill": prefill,
+        "tokens": tokens,
+        "decode": decode,
+        "peak": max(tokens, decode),
+    }
+
+
+def current_rss():
+    """
+    当前进程的常驻内存（字节）
+
+    没有psutil且不是Linux时，返回进程历史上的峰值RSS。
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS上单位是字节，Linux上是KB
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _tensor_memory(device):
+    """设备上已分配的张量内存（字节），CPU上没有分配器统计时返回None"""
+    if device.type == "cuda":
+        return torch.cuda.memory_allocated(device)
+    if device.type == "mps":
+        return torch.mps.current_allocated_memory()
+    return None
+
+
+def freeze_baseline():
+    """
+    把当前所有对象移出垃圾回收的扫描范围
+
+    导入torch/transformers并加载模型后进程中有几十万个长期存在的对象，
+    一次完整的gc.collect()需要两百多毫秒；冻结之后 release_memory() 只扫描请求中新建的对象。
+    """
+    gc.collect()
+    gc.freeze()
+
+
+def release_memory(device):
+    """
+    显式释放缓存，让内存回到基线
+
+    依次执行垃圾回收、清空CUDA/MPS的缓存分配器，
+    Linux上再调用glibc的malloc_trim把空闲的堆内存还给操作系统。
+
+    参数:
+        device (torch.device): 计算设备
+    """
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    elif device.type == "mps":
+        torch.mps.empty_cache()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+class MemoryTracker:
+    """
+    统计一段代码执行期间的内存峰值
+
+    RSS和张量内存（CUDA/MPS）都由后台线程定期采样，CPU上没有张量统计。
+    不使用CUDA的峰值统计（reset_peak_memory_stats），因为它是进程全局的，
+    流水线的两个阶段同时统计时会互相清零。
+
+    注意：RSS是整个进程的内存，流水线的两个阶段同时运行时会互相计入。
+
+    使用示例:
+        with MemoryTracker(device) as tracker:
+            generate()
+        print(tracker.result())
+    """
+
+    def __init__(self, device, interval=0.005):
+        """
+        参数:
+            device (torch.device): 计算设备
+            interval (float): RSS采样间隔（秒）
+        """
+        self.device = device
+        self.interval = interval
+        self.rss_baseline = 0
+        self.rss_peak = 0
+        self.tensor_baseline = None
+        self.tensor_peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        self.rss_peak = max(self.rss_peak, current_rss())
+        if self.tensor_peak is not None:
+            self.tensor_peak = max(self.tensor_peak, _tensor_memory(self.device))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.rss_baseline = self.rss_peak = current_rss()
+        self.tensor_baseline = self.tensor_peak = _tensor_memory(self.device)
+        self._thread = threading.Thread(target=self._run, name="memory-tracker", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+    def result(self):
+        """
+        返回值:
+            dict: rss_baseline、rss_peak、rss_delta（峰值减基线），
+                tensor_peak、tensor_delta（CPU上为None），单位都是字节
+        """
+        tensor_delta = None
+        if self.tensor_peak is not None:
+            tensor_delta = self.tensor_peak - self.tensor_baseline
+        return {
+            "rss_baseline": self.rss_baseline,
+            "rss_peak": self.rss_peak,
+            "rss_delta": self.rss_peak - self.rss_baseline,
+            "tensor_peak": self.tensor_peak,
+            "tensor_delta": tensor_delta,
+        }
+
+
+def merge_memory_results(results):
+    """
+    合并分批执行时每一批的 MemoryTracker.result()
+
+    各批依次执行，所以峰值和增量取最大值，基线取第一批的基线。
+
+    参数:
+        results (list[dict]): 每一批的统计结果
+
+    返回值:
+        dict: 与 MemoryTracker.result() 格式相同
+    """
+    if len(results) == 1:
+        return results[0]
+    merged = {"rss_baseline": results[0]["rss_baseline"]}
+    for key in ("rss_peak", "rss_delta", "tensor_peak", "tensor_delta"):
+        values = [result[key] for result in results if result[key] is not None]
+        merged[key] = max(values) if values else None
+    return merged
+
+
+class MemoryGuard:
+    """
+    内存预算守卫
+
+    两种作用：
+    1. plan(): 提交请求时检查预估内存，超出预算的请求按策略拆分成几批或直接拒绝
+    2. reserve(): 流水线的每个阶段执行前预留预估的内存；
+       预算不够时等待其他阶段释放（排队），而不是同时运行把进程挤爆
+
+    同一个进程中的所有模型共用一个守卫。
+    """
+
+    def __init__(self, budget, policy="split"):
+        """
+        参数:
+            budget (int): 生成过程可以使用的内存预算（字节，不含模型权重）
+            policy (str): 超出预算时的处理方式，见 MEMORY_POLICIES
+        """
+        if policy not in MEMORY_POLICIES:
+            raise ValueError(f"不支持的内存策略: {policy}，可选: {', '.join(MEMORY_POLICIES)}")
+        self.budget = budget
+        self.policy = policy
+        self._condition = threading.Condition()
+        self._reserved = 0
+        self._stats = {"peak_reserved": 0, "rejected": 0, "split": 0, "waits": 0, "wait_time": 0.0}
+
+    def plan(self, estimate, num_variations):
+        """
+        根据预估内存决定每批生成的变体数量
+
+        参数:
+            estimate (callable): 输入变体数量，返回 estimate_generation_memory() 的结果
+            num_variations (int): 请求的变体数量
+
+        返回值:
+            list[int]: 每批的变体数量，总和等于num_variations
+
+        异常:
+            MemoryBudgetExceeded: 按策略无法在预算内完成
+        """
+        if estimate(num_variations)["peak"] <= self.budget:
+            return [num_variations]
+
+        batch_size = num_variations - 1
+        while batch_size > 0 and estimate(batch_size)["peak"] > self.budget:
+            batch_size -= 1
+
+        if self.policy == "reject" or batch_size == 0:
+            with self._condition:
+                self._stats["rejected"] += 1
+            needed = estimate(num_variations if self.policy == "reject" else 1)["peak"]
+            raise MemoryBudgetExceeded(
+                f"预估内存 {needed / MB:.0f}MB 超出预算 {self.budget / MB:.0f}MB，请减少max_tokens或变体数量"
+            )
+
+        with self._condition:
+            self._stats["split"] += 1
+        batches = [batch_size] * (num_variations // batch_size)
+        if num_variations % batch_size:
+            batches.append(num_variations % batch_size)
+        return batches
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        """
+        预留内存，预算不够时等待
+
+        没有其他预留时总是立即通过（单个请求是否超出预算由plan()检查），避免死锁。
+
+        参数:
+            nbytes (int): 预留的字节数
+        """
+        with self._condition:
+            if self._reserved > 0 and self._reserved + nbytes > self.budget:
+                start_time = time.perf_counter()
+                self._stats["waits"] += 1
+                while self._reserved > 0 and self._reserved + nbytes > self.budget:
+                    self._condition.wait()
+                self._stats["wait_time"] += time.perf_counter() - start_time
+            self._reserved += nbytes
+            self._stats["peak_reserved"] = max(self._stats["peak_reserved"], self._reserved)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._reserved -= nbytes
+                self._condition.notify_all()
+
+    def stats(self):
+        """
+        返回值:
+            dict: budget、policy、reserved（当前预留）、peak_reserved、rejected、split、waits、wait_time
+        """
+        with self._condition:
+            return {"budget": self.budget, "policy": self.policy, "reserved": self._reserved, **self._stats}
+
+
+# 如果直接运行这个文件，打印各模型在不同参数下的预估内存
+if __name__ == "__main__":
+    print("🧪 预估内存（不含模型权重，单位MB）")
+    print(
+        f"{'模型':<8}{'变体':>6}{'token':>8}{'开头':>6}{'引导':>8}"
+        f"{'KV缓存':>10}{'激活值':>10}{'预填充':>10}{'解码':>10}{'峰值':>10}"
+    )
+    cases = ((1, 256, 0, None), (4, 256, 0, None), (4, 256, 0, 32), (1, 1500, 0, None), (1, 256, 1500, None))
+    for model_size in MODEL_SHAPES:
+        for batch_size, max_tokens, prompt_frames, guidance_steps in cases:
+            # 续写时开头的帧和生成的token一起计入长度
+            estimate = estimate_generation_memory(
+                MODEL_SHAPES[model_size], batch_size, max_tokens + prompt_frames,
+                guidance_steps=guidance_steps, prompt_frames=prompt_frames,
+            )
+            print(
+                f"{model_size:<8}{batch_size:>6}{max_tokens:>8}{prompt_frames:>6}{str(guidance_steps or '全部'):>8}"
+                f"{estimate['kv_cache'] / MB:>10.0f}{estimate['activations'] / MB:>10.0f}{estimate['prefill'] / MB:>10.0f}"
+                f"{estimate['decode'] / MB:>10.0f}{estimate['peak'] / MB:>10.0f}"
+            )
+    print(f"\n当前进程RSS: {current_rss() / MB:.0f}MB")
@@ -2,7 +2,8 @@
 MusicGen模型模块
 
 这个模块实现了Facebook的MusicGen模型，用于文本到音乐的生成。
-MusicGen是一个基于Transformer的AI模型，可以根据文本描述生成音乐。
+MusicGen是一个基于Transformer的AI模型，可以根据文本描述生成音乐，
+也可以接着一段已有的音频续写（generate_continuation）。
 
 支持的模型大小：
 - small: 300M参数，适合快速生成和测试
@@ -13,11 +14,41 @@ MusicGen是一个基于Transformer的AI模型，可以根据文本描述生成
 """
 
 # 导入必要的库
+import os  # 用于处理文件路径
+import random  # 用于生成随机种子
 import time  # 用于计时
+import math  # 用于计算重采样的比例
+from scipy import signal  # 续写时把开头的音频重采样到模型的采样率
 from transformers import AutoProcessor, MusicgenForConditionalGeneration  # Hugging Face的模型库
 import torch  # PyTorch深度学习框架
 import scipy.io.wavfile  # 用于保存音频文件
 
+# 导入解码循环（文本编码、音频token生成、音频解码）
+# 作为包导入时使用相对导入，直接运行这个文件时使用同目录导入
+try:
+    from .decoding import (
+        CACHE_LENGTH_BUCKET, DecoderStep, encode_text, sample_audio_codes, encode_audio_codes, decode_audio_codes, make_generators
+    )
+except ImportError:
+    from decoding import (
+        CACHE_LENGTH_BUCKET, DecoderStep, encode_text, sample_audio_codes, encode_audio_codes, decode_audio_codes, make_generators
+    )
+
+# 导入续写用的音频开头和音频token缓存
+try:
+    from .continuation import AudioCodeCache, AudioPrompt
+except ImportError:
+    from continuation import AudioCodeCache, AudioPrompt
+
+# 导入内存估算和统计工具
+try:
+    from .memory import MB, MODEL_SHAPES, MemoryTracker, current_rss, estimate_generation_memory, freeze_baseline, model_shape, release_memory
+except ImportError:
+    from memory import MB, MODEL_SHAPES, MemoryTracker, current_rss, estimate_generation_memory, freeze_baseline, model_shape, release_memory
+
+# 没有加载模型时估算内存使用的默认引导系数（与模型的生成配置一致）
+DEFAULT_GUIDANCE_SCALE = 3.0
+
 class MusicGen:
     """
     MusicGen模型类
@@ -29,7 +60,7 @@ class MusicGen:
     - 音频保存
     """
     
-    def __init__(self, model_size="small", device=None):
+    def __init__(self, model_size="small", device=None, compile=False):
         """
         初始化MusicGen模型
         
@@ -38,6 +69,8 @@ class MusicGen:
                 - small: 300M参数，加载快，内存需求少
                 - medium: 1.5B参数，质量高，但需要更多内存和时间
             device (torch.device): 计算设备，如果为None则自动选择
+            compile (bool): 是否启用编译模式（静态KV缓存 + torch.compile），
+                首次生成需要额外的编译时间，之后每一步解码更快；编译失败时自动回退到eager模式
         
         使用示例:
             # 创建small模型实例
@@ -58,6 +91,13 @@ class MusicGen:
         # 初始化模型和处理器为None，延迟加载
         self.processor = None  # 文本处理器
         self.model = None      # 音乐生成模型
+        
+        # 单步解码器（eager或编译模式），在模型加载后创建
+        self.compile = compile
+        self.decoder_step = None
+        
+        # 续写开头的音频token缓存（按文件内容的哈希），反复续写同一段音频时不需要重新编码
+        self.code_cache = AudioCodeCache()
 
     def load_model(self):
         """
@@ -86,6 +126,12 @@ class MusicGen:
         # 将模型移动到指定的计算设备（CPU/GPU/MPS）
         self.model.to(self.device)
         
+        # 创建单步解码器，编译模式下会准备torch.compile和编译缓存
+        self.decoder_step = DecoderStep(self.model, compile=self.compile)
+        
+        # 模型已经常驻内存，冻结当前的对象，之后每个请求结束时的垃圾回收只需要扫描新对象
+        freeze_baseline()
+        
         # 计算并显示加载耗时
         load_time = time.time() - start_time
         print(f"✅ 模型加载完成 (耗时: {load_time:.2f}秒)")
@@ -106,7 +152,393 @@ class MusicGen:
         # medium模型使用更多token，生成更长的音乐
         return 512 if self.model_size == "medium" else 256
 
-    def generate(self, prompt, max_tokens=None, output_path=None):
+    def memory_shape(self):
+        """
+        获取估算内存使用的模型结构参数
+        
+        模型已加载时从模型配置中读取，否则使用 MODEL_SHAPES 中对应模型的参数，
+        这样在加载模型之前就能检查请求是否超出内存预算。
+        
+        返回值:
+            dict: 模型结构参数，见 memory.MODEL_SHAPES
+        """
+        if isinstance(self.model, MusicgenForConditionalGeneration):
+            return model_shape(self.model.config)
+        return MODEL_SHAPES[self.model_size]
+
+    def estimate_memory(self, max_tokens=None, num_variations=1, guidance_scale=None, guidance_steps=None, prompt_seconds=0.0):
+        """
+        预估一次生成需要的内存（不含模型权重）
+        
+        参数:
+            与 generate_codes() 相同
+            prompt_seconds (float): 续写时开头音频的时长，开头的token也占用KV缓存，并且会一起解码
+        
+        返回值:
+            dict: 各部分的字节数（kv_cache / activations / prefill / tokens / decode / peak），
+                见 memory.estimate_generation_memory()
+        """
+        max_tokens = max_tokens or self.get_default_max_tokens()
+        shape = self.memory_shape()
+        
+        # 续写时开头的帧和生成的token一样占用KV缓存和解码内存，第一步还要一次预填充整个开头；
+        # 只在前K步引导时，丢弃无条件分支之前缓存里已经有了开头的全部帧（K为0时完全不引导）
+        prompt_frames = math.ceil(prompt_seconds * shape["frame_rate"])
+        total_tokens = max_tokens + prompt_frames
+        if guidance_steps:
+            guidance_steps = guidance_steps + prompt_frames
+        
+        # 与解码循环相同的规则判断是否使用引导
+        if guidance_scale is None:
+            generation_config = getattr(self.model, "generation_config", None)
+            guidance_scale = getattr(generation_config, "guidance_scale", DEFAULT_GUIDANCE_SCALE)
+        guidance = guidance_scale is not None and guidance_scale > 1
+        
+        # 编译模式下静态KV缓存按长度分桶，一开始就分配到桶的大小
+        static_cache_length = None
+        if self.compile:
+            static_cache_length = -(-(total_tokens + 1) // CACHE_LENGTH_BUCKET) * CACHE_LENGTH_BUCKET
+        
+        # 按模型参数的实际精度计算（float16模型的KV缓存只有float32的一半）
+        dtype_bytes = 4
+        if isinstance(self.model, MusicgenForConditionalGeneration):
+            dtype_bytes = next(self.model.parameters()).element_size()
+        
+        return estimate_generation_memory(
+            shape,
+            num_variations,
+            total_tokens,
+            guidance=guidance,
+            guidance_steps=guidance_steps,
+            dtype_bytes=dtype_bytes,
+            static_cache_length=static_cache_length,
+            prompt_frames=prompt_frames,
+        )
+
+    def encode_waveform(self, audio, sampling_rate):
+        """
+        用EnCodec把音频波形编码为音频token（decode_codes() 的逆过程）
+        
+        音频会先转换为模型的声道数（单声道取平均，立体声复制单声道）并重采样到模型的采样率。
+        
+        参数:
+            audio (np.ndarray): float32音频，形状为 (channels, samples)
+            sampling_rate (int): 音频的采样率
+        
+        返回值:
+            dict: 包含以下内容
+                - audio_codes: 形状为 (1, num_codebooks, frames) 的音频token
+                - encode_time: 编码耗时（秒）
+        """
+        # 如果模型还没加载，先加载模型
+        if self.model is None:
+            self.load_model()
+        
+        start_time = time.time()
+        
+        # 转换为模型的声道数
+        channels = self.model.decoder.config.audio_channels
+        if audio.shape[0] != channels:
+            audio = audio.mean(axis=0, keepdims=True).repeat(channels, axis=0)
+        
+        # 重采样到模型的采样率（通常是32000Hz）
+        target_rate = self.model.config.audio_encoder.sampling_rate
+        if sampling_rate != target_rate:
+            divisor = math.gcd(sampling_rate, target_rate)
+            audio = signal.resample_poly(audio, target_rate // divisor, sampling_rate // divisor, axis=-1)
+        
+        with torch.no_grad():
+            audio_values = torch.from_numpy(audio.astype("float32"))[None].to(self.device)
+            audio_codes = encode_audio_codes(self.model, audio_values)
+        
+        return {
+            "audio_codes": audio_codes,
+            "encode_time": time.time() - start_time,
+        }
+
+    def encode_audio(self, audio_prompt):
+        """
+        把续写的开头编码为音频token，编码结果按文件内容的哈希缓存
+        
+        参数:
+            audio_prompt (AudioPrompt): 续写的开头
+        
+        返回值:
+            dict: 包含以下内容
+                - audio_codes: 形状为 (1, num_codebooks, frames) 的音频token
+                - key: 文件内容的哈希
+                - cached: 是否命中缓存（命中时没有重新编码）
+                - encode_time: 这次编码的耗时（秒），命中缓存时为0
+                - saved_time: 命中缓存节省的编码时间（秒），即第一次编码时的耗时
+                - duration: 开头音频的时长（秒）
+        """
+        entry = self.code_cache.get(audio_prompt.key)
+        if entry is not None:
+            print(f"♻️ 开头的音频token命中缓存，跳过编码 (节省 {entry['encode_time']:.2f}秒)")
+            return {
+                "audio_codes": entry["audio_codes"],
+                "key": audio_prompt.key,
+                "cached": True,
+                "encode_time": 0.0,
+                "saved_time": entry["encode_time"],
+                "duration": audio_prompt.duration,
+            }
+        
+        print(f"🎧 正在编码开头的音频 ({audio_prompt.duration:.2f}秒)...")
+        encoded = self.encode_waveform(audio_prompt.audio, audio_prompt.sampling_rate)
+        self.code_cache.put(audio_prompt.key, encoded["audio_codes"], encoded["encode_time"])
+        print(f"⏱️ 编码耗时: {encoded['encode_time']:.2f}秒")
+        return {
+            "audio_codes": encoded["audio_codes"],
+            "key": audio_prompt.key,
+            "cached": False,
+            "encode_time": encoded["encode_time"],
+            "saved_time": 0.0,
+            "duration": audio_prompt.duration,
+        }
+
+    def generate_codes(
+        self, prompt, max_tokens=None, num_variations=1, seed=None, guidance_scale=None, guidance_steps=None, audio_prompt=None
+    ):
+        """
+        第一阶段：生成音频token（不解码为波形）
+        
+        提示词只编码一次，然后复制到整个batch，
+        每个变体使用独立的随机种子，所有变体在同一个解码循环中一起生成。
+        
+        参数:
+            prompt (str): 音乐描述文本
+            max_tokens (int, 可选): 最大生成token数，决定音乐长度
+            num_variations (int): 生成的变体数量，默认1个
+            seed (int, 可选): 随机种子，第i个变体使用 seed + i；为None时随机选择
+            guidance_scale (float, 可选): 无分类器引导系数，默认3.0；小于等于1时关闭引导
+            guidance_steps (int, 可选): 只在前K步使用引导，之后每一步的计算量减半；None表示全程引导
+            audio_prompt (torch.LongTensor, 可选): 续写的开头，encode_audio() 返回的音频token，
+                每个变体都接着同一个开头生成
+        
+        返回值:
+            dict: 包含以下内容
+                - audio_codes: 形状为 (num_variations, num_codebooks, frames) 的音频token，续写时包含开头
+                - seeds: 每个变体使用的随机种子
+                - token_time: token生成耗时（秒）
+                - memory: 这个阶段的内存统计，见 MemoryTracker.result()
+        
+        异常:
+            ValueError: 变体数量小于1，或续写的开头太长
+        """
+        if num_variations < 1:
+            raise ValueError(f"变体数量必须至少为1: {num_variations}")
+        
+        # 如果模型还没加载，先加载模型
+        if self.model is None:
+            self.load_model()
+        
+        # 如果没有指定max_tokens，使用默认值
+        max_tokens = max_tokens or self.get_default_max_tokens()
+        
+        # 为每个变体分配独立的随机种子，方便单独复现某一个变体
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        seeds = [seed + i for i in range(num_variations)]
+        
+        # 显示生成信息
+        print(f"🎵 生成音乐: '{prompt}'")
+        print(f"📊 模型: {self.model_size}, 最大token数: {max_tokens}, 变体数: {num_variations}")
+        if audio_prompt is not None:
+            # 位置编码的长度有限，开头和生成的token加起来不能超过
+            max_positions = self.model.decoder.config.max_position_embeddings
+            if audio_prompt.shape[-1] + max_tokens + 1 > max_positions:
+                raise ValueError(
+                    f"开头({audio_prompt.shape[-1]}帧)加上生成的token数({max_tokens})超出了模型的最大长度({max_positions})"
+                )
+            print(f"🎧 续写: 开头 {audio_prompt.shape[-1]} 帧")
+            audio_prompt = audio_prompt.to(self.device).expand(num_variations, -1, -1)
+        if guidance_scale is not None or guidance_steps is not None:
+            print(f"🧭 引导系数: {guidance_scale if guidance_scale is not None else '默认'}, 引导步数: {guidance_steps if guidance_steps is not None else '全部'}")
+        
+        # 开始生成音频token
+        print("🎼 正在生成音频token...")
+        start_time = time.time()
+        
+        # 使用torch.no_grad()禁用梯度计算，节省内存；同时统计这个阶段的内存峰值
+        with torch.no_grad(), MemoryTracker(self.device) as tracker:
+            # 1. 文本只编码一次，再复制给每个变体
+            encoder_hidden_states, encoder_attention_mask = encode_text(
+                self.model, self.processor, [prompt], self.device, num_variations=num_variations
+            )
+            
+            # 2. 所有变体在同一个解码循环中生成音频token
+            audio_codes = sample_audio_codes(
+                self.model,
+                encoder_hidden_states,
+                encoder_attention_mask,
+                max_new_tokens=max_tokens,
+                generators=make_generators(seeds, self.device),
+                guidance_scale=guidance_scale,
+                guidance_steps=guidance_steps,
+                decoder_step=self.decoder_step,
+                audio_prompt_codes=audio_prompt,
+            )
+        
+        # 计算token生成耗时
+        token_time = time.time() - start_time
+        print(f"⏱️ token生成耗时: {token_time:.2f}秒")
+        
+        return {
+            "audio_codes": audio_codes,
+            "seeds": seeds,
+            "token_time": token_time,
+            "memory": tracker.result(),
+        }
+
+    def decode_codes(self, audio_codes):
+        """
+        第二阶段：用EnCodec把音频token解码为波形
+        
+        这个阶段只用到模型中的音频编解码器，
+        所以可以和下一个请求的token生成同时进行（见 pipeline.py）。
+        
+        参数:
+            audio_codes (torch.LongTensor): generate_codes() 返回的音频token
+        
+        返回值:
+            dict: 包含以下内容
+                - audio: list[np.ndarray]，每个变体的音频
+                - sampling_rate: 采样率
+                - decode_time: 解码耗时（秒）
+                - memory: 这个阶段的内存统计，见 MemoryTracker.result()
+        """
+        start_time = time.time()
+        
+        with torch.no_grad(), MemoryTracker(self.device) as tracker:
+            audio_values = decode_audio_codes(self.model, audio_codes)
+            
+            # 将音频张量转换为numpy数组
+            # .cpu(): 将张量从GPU移动到CPU
+            # .numpy(): 转换为numpy数组
+            # .squeeze(): 移除多余的维度
+            audio = [values.cpu().numpy().squeeze() for values in audio_values]
+        
+        return {
+            "audio": audio,
+            # 从模型配置中获取采样率（通常是32000Hz）
+            "sampling_rate": self.model.config.audio_encoder.sampling_rate,
+            "decode_time": time.time() - start_time,
+            "memory": tracker.result(),
+        }
+
+    def generate_audio(
+        self, prompt, max_tokens=None, num_variations=1, seed=None, guidance_scale=None, guidance_steps=None, audio_prompt=None
+    ):
+        """
+        生成音频波形（不保存文件），依次执行token生成和音频解码两个阶段
+        
+        参数:
+            与 generate_codes() 相同
+        
+        返回值:
+            dict: 包含以下内容
+                - audio: list[np.ndarray]，每个变体的音频
+                - sampling_rate: 采样率
+                - seeds: 每个变体使用的随机种子
+                - generation_time: 生成总耗时（秒）
+                - timings: 各阶段耗时（tokens / decode）
+                - memory: 各阶段的内存统计（tokens / decode），以及释放缓存后的RSS（rss_after）
+        """
+        codes = self.generate_codes(
+            prompt,
+            max_tokens=max_tokens,
+            num_variations=num_variations,
+            seed=seed,
+            guidance_scale=guidance_scale,
+            guidance_steps=guidance_steps,
+            audio_prompt=audio_prompt,
+        )
+        decoded = self.decode_codes(codes["audio_codes"])
+        
+        generation_time = codes["token_time"] + decoded["decode_time"]
+        print(f"⏱️ 生成耗时: {generation_time:.2f}秒 (音频解码: {decoded['decode_time']:.2f}秒)")
+        
+        # 生成结束后显式释放缓存（KV缓存、解码的中间结果），让内存回到基线
+        release_memory(self.device)
+        memory = {"tokens": codes["memory"], "decode": decoded["memory"], "rss_after": current_rss()}
+        print(
+            f"💾 内存峰值: token阶段 +{memory['tokens']['rss_delta'] / MB:.0f}MB, "
+            f"解码阶段 +{memory['decode']['rss_delta'] / MB:.0f}MB, 释放后RSS {memory['rss_after'] / MB:.0f}MB"
+        )
+        
+        return {
+            "audio": decoded["audio"],
+            "sampling_rate": decoded["sampling_rate"],
+            "seeds": codes["seeds"],
+            "generation_time": generation_time,
+            "timings": {"tokens": codes["token_time"], "decode": decoded["decode_time"]},
+            "memory": memory,
+        }
+
+    def save_audio(self, audio, sampling_rate, seeds, output_path, postprocessor=None):
+        """
+        保存音频文件，每个变体一个文件
+        
+        参数:
+            audio (list[np.ndarray]): 每个变体的音频
+            sampling_rate (int): 音频采样率
+            seeds (list[int]): 每个变体使用的随机种子
+            output_path (str): 输出文件路径，多个变体时会加上 _1、_2 ... 后缀
+            postprocessor (AudioPostProcessor, 可选): 音频后处理器
+        
+        返回值:
+            list[dict]: 每个变体的信息（file_path、filename、duration、seed、sample_rate、postprocess_time）
+        """
+        variations = []
+        for path, audio_numpy, variation_seed in zip(variation_paths(output_path, len(audio)), audio, seeds):
+            rate = sampling_rate
+            postprocess_time = 0.0
+            
+            # 如果提供了后处理器，在保存之前处理音频
+            # 重采样后采样率会变化，所以要使用后处理器的输出采样率
+            if postprocessor is not None:
+                if postprocessor.sample_rate != rate:
+                    raise ValueError(f"后处理器采样率({postprocessor.sample_rate}Hz)与模型采样率({rate}Hz)不一致")
+                postprocessor.reset_timings()
+                audio_numpy = postprocessor.process(audio_numpy)
+                rate = postprocessor.output_rate
+                postprocess_time = sum(postprocessor.timings.values())
+                stages = ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in postprocessor.timings.items())
+                print(f"🎚️ 后处理完成: {stages}")
+            
+            # 使用scipy保存为WAV文件
+            scipy.io.wavfile.write(path, rate=rate, data=audio_numpy)
+            
+            # 计算音频时长
+            duration = audio_numpy.shape[-1] / rate
+            
+            # 显示完成信息
+            print(f"✅ 音乐生成完成! 保存位置: {path} (种子: {variation_seed})")
+            print(f"🎶 音频时长: {duration:.2f}秒, 采样率: {rate}Hz")
+            
+            variations.append({
+                "file_path": path,
+                "filename": os.path.basename(path),
+                "duration": duration,
+                "seed": variation_seed,
+                "sample_rate": rate,
+                "postprocess_time": postprocess_time,
+            })
+        return variations
+
+    def generate(
+        self,
+        prompt,
+        max_tokens=None,
+        output_path=None,
+        postprocessor=None,
+        num_variations=1,
+        seed=None,
+        guidance_scale=None,
+        guidance_steps=None,
+        audio_prompt=None,
+    ):
         """
         生成音乐
         
@@ -116,9 +548,18 @@ class MusicGen:
             prompt (str): 音乐描述文本，例如 "A peaceful piano melody"
             max_tokens (int, 可选): 最大生成token数，决定音乐长度
             output_path (str, 可选): 输出文件路径，如果为None则自动生成
+                生成多个变体时，会在文件名后加上 _1、_2 ... 后缀
+            postprocessor (AudioPostProcessor, 可选): 音频后处理器，
+                如果提供则在保存前做归一化、淡入淡出、重采样等处理
+            num_variations (int): 生成的变体数量，默认1个
+            seed (int, 可选): 随机种子，第i个变体使用 seed + i
+            guidance_scale (float, 可选): 无分类器引导系数，小于等于1时关闭引导
+            guidance_steps (int, 可选): 只在前K步使用引导
+            audio_prompt (torch.LongTensor, 可选): 续写的开头的音频token，见 generate_continuation()
         
         返回值:
-            str: 生成的音频文件路径
+            str: 生成的音频文件路径（num_variations为1时）
+            list[str]: 每个变体的音频文件路径（num_variations大于1时）
         
         使用示例:
             # 基本使用
@@ -130,13 +571,22 @@ class MusicGen:
                 max_tokens=1024,
                 output_path="my_music.wav"
             )
+            
+            # 一次生成4个变体
+            generator.generate("A jazz piece", num_variations=4)
+            
+            # 快速模式：只在前32步使用引导
+            generator.generate("A jazz piece", guidance_steps=32)
         """
-        # 如果模型还没加载，先加载模型
-        if self.model is None:
-            self.load_model()
-        
-        # 如果没有指定max_tokens，使用默认值
-        max_tokens = max_tokens or self.get_default_max_tokens()
+        result = self.generate_audio(
+            prompt,
+            max_tokens=max_tokens,
+            num_variations=num_variations,
+            seed=seed,
+            guidance_scale=guidance_scale,
+            guidance_steps=guidance_steps,
+            audio_prompt=audio_prompt,
+        )
         
         # 如果没有指定输出路径，自动生成文件名
         if output_path is None:
@@ -144,53 +594,53 @@ class MusicGen:
             timestamp = int(time.time())
             output_path = f"music_{self.model_size}_{timestamp}.wav"
         
-        # 显示生成信息
-        print(f"🎵 生成音乐: '{prompt}'")
-        print(f"📊 模型: {self.model_size}, 最大token数: {max_tokens}")
-        
-        # 使用处理器将文本转换为模型输入
-        # padding=True: 自动填充到相同长度
-        # return_tensors="pt": 返回PyTorch张量
-        inputs = self.processor(
-            text=[prompt],  # 文本列表，这里只有一个文本
-            padding=True,   # 自动填充
-            return_tensors="pt",  # 返回PyTorch张量
-        ).to(self.device)  # 移动到指定设备
-        
-        # 开始生成音频
-        print("🎼 正在生成音频...")
-        start_time = time.time()
-        
-        # 使用torch.no_grad()禁用梯度计算，节省内存
-        with torch.no_grad():
-            # 调用模型生成音频
-            audio_values = self.model.generate(**inputs, max_new_tokens=max_tokens)
-        
-        # 计算生成耗时
-        generation_time = time.time() - start_time
-        print(f"⏱️ 生成耗时: {generation_time:.2f}秒")
-        
-        # 从模型配置中获取采样率（通常是32000Hz）
-        sampling_rate = self.model.config.audio_encoder.sampling_rate
+        variations = self.save_audio(
+            result["audio"], result["sampling_rate"], result["seeds"], output_path, postprocessor=postprocessor
+        )
         
-        # 将音频张量转换为numpy数组并保存
-        # .cpu(): 将张量从GPU移动到CPU
-        # .numpy(): 转换为numpy数组
-        # .squeeze(): 移除多余的维度
-        audio_numpy = audio_values[0].cpu().numpy().squeeze()
+        # 返回输出文件路径
+        output_paths = [variation["file_path"] for variation in variations]
+        return output_paths[0] if num_variations == 1 else output_paths
+
+    def generate_continuation(self, audio, prompt, **options):
+        """
+        接着一段已有的音频续写
         
-        # 使用scipy保存为WAV文件
-        scipy.io.wavfile.write(output_path, rate=sampling_rate, data=audio_numpy)
+        开头先编码为音频token（按文件内容缓存，同一段音频第二次续写时跳过编码），
+        生成的文件包含开头和续写的部分。
         
-        # 计算音频时长
-        duration = len(audio_numpy) / sampling_rate
+        参数:
+            audio (str 或 AudioPrompt): 开头的WAV文件路径
+            prompt (str): 音乐描述文本
+            **options: 传给 generate() 的其他参数（max_tokens、output_path、num_variations、seed等）
         
-        # 显示完成信息
-        print(f"✅ 音乐生成完成! 保存位置: {output_path}")
-        print(f"🎶 音频时长: {duration:.2f}秒, 采样率: {sampling_rate}Hz")
+        返回值:
+            与 generate() 相同
         
-        # 返回输出文件路径
-        return output_path
+        使用示例:
+            generator.generate_continuation("intro.wav", "A calm piano melody", max_tokens=256)
+        """
+        if not isinstance(audio, AudioPrompt):
+            audio = AudioPrompt.from_file(audio)
+        encoded = self.encode_audio(audio)
+        return self.generate(prompt, audio_prompt=encoded["audio_codes"], **options)
+
+
+def variation_paths(output_path, num_variations):
+    """
+    为每个变体生成输出文件路径
+    
+    参数:
+        output_path (str): 基础文件路径，例如 "music.wav"
+        num_variations (int): 变体数量
+    
+    返回值:
+        list[str]: 只有一个变体时返回原路径，否则为 "music_1.wav"、"music_2.wav" ...
+    """
+    if num_variations == 1:
+        return [output_path]
+    root, ext = os.path.splitext(output_path)
+    return [f"{root}_{i + 1}{ext}" for i in range(num_variations)]
 
 # 如果直接运行这个文件，会执行以下测试代码
 if __name__ == "__main__":
@@ -0,0 +1,361 @@
+"""
+流水线生成模块
+
+这个模块把一次音乐生成拆成两个阶段，分别由两个后台线程执行：
+1. token阶段: 语言模型自回归生成音频token（MusicGen.generate_codes）
+2. 解码阶段: EnCodec解码 + 后处理 + 写WAV文件（MusicGen.decode_codes / save_audio）
+
+续写请求在token阶段先把开头编码为音频token（命中缓存时跳过），再接着生成。
+
+两个阶段之间用有界队列连接，所以当第N个请求在解码和写文件时，
+第N+1个请求的token生成已经开始了。持续有请求时，
+吞吐量大约能提高"解码阶段占总耗时的比例"。
+
+配置了内存守卫（MemoryGuard）时，提交请求前先预估内存：
+超出预算的请求被拒绝或拆成几批生成，两个阶段执行前都要预留预估的内存，
+预算不够时排队等待。每个请求结束后显式释放缓存。
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入必要的库
+import contextlib  # 用于在CPU上提供空的上下文管理器
+import queue  # 线程安全的队列
+import random  # 用于生成随机种子
+import threading  # 后台工作线程
+import time  # 用于计时
+from concurrent.futures import Future  # 用于把结果交回给提交请求的线程
+
+import torch  # PyTorch深度学习框架
+
+# 作为包导入时使用相对导入，直接运行这个文件时使用同目录导入
+try:
+    from .memory import current_rss, merge_memory_results, release_memory
+except ImportError:
+    from memory import current_rss, merge_memory_results, release_memory
+
+# 流水线中的阶段名称，按执行顺序排列
+# decode_queue 是token阶段完成到解码阶段开始之间的等待（解码队列满时的背压 + 在队列中排队）
+STAGES = ("queue", "encode", "tokens", "decode_queue", "decode", "write", "total")
+
+
+class _Job:
+    """一个生成请求在流水线中的状态"""
+
+    def __init__(
+        self, prompt, output_path, max_tokens, num_variations, seed, guidance_scale, guidance_steps, postprocessor, batches, estimate,
+        audio_prompt,
+    ):
+        self.prompt = prompt
+        self.output_path = output_path
+        self.max_tokens = max_tokens
+        self.num_variations = num_variations
+        self.seed = seed
+        self.guidance_scale = guidance_scale
+        self.guidance_steps = guidance_steps
+        self.postprocessor = postprocessor
+        # 每批生成的变体数量（没有超出内存预算时只有一批），以及按变体数量预估内存的函数
+        self.batches = batches
+        self.estimate = estimate
+        # 续写的开头（AudioPrompt），从头生成时为None
+        self.audio_prompt = audio_prompt
+        self.prompt_info = None
+        self.future = Future()
+        self.submitted = time.perf_counter()
+        self.tokens_done = None
+        self.codes = None
+        self.timings = {}
+        self.memory = {}
+
+
+class GenerationPipeline:
+    """
+    两阶段生成流水线
+
+    使用示例:
+        engine = MusicGen(model_size="small")
+        pipeline = GenerationPipeline(engine)
+
+        # submit() 立即返回一个Future，result() 等待生成完成
+        future = pipeline.submit("A calm piano melody", output_path="music.wav")
+        result = future.result()
+        print(result["timings"])  # {'queue': ..., 'tokens': ..., 'decode_queue': ..., 'decode': ..., 'write': ..., 'total': ...}
+
+        pipeline.shutdown()
+    """
+
+    def __init__(self, engine, max_pending_decodes=2, memory_guard=None):
+        """
+        初始化流水线并启动两个工作线程
+
+        参数:
+            engine (MusicGen): 生成引擎，两个阶段共享同一个模型
+            max_pending_decodes (int): 等待解码的请求数上限，
+                解码跟不上时token阶段会暂停，避免音频token在内存中堆积
+            memory_guard (MemoryGuard, 可选): 内存预算守卫，多个流水线可以共用一个；
+                为None时不检查预算
+        """
+        self.engine = engine
+        self.memory_guard = memory_guard
+        self._token_queue = queue.Queue()
+        self._decode_queue = queue.Queue(maxsize=max_pending_decodes)
+        self._stats_lock = threading.Lock()
+        self._stats = {stage: {"count": 0, "total": 0.0} for stage in STAGES}
+        self._memory_stats = {"tokens_peak": 0, "decode_peak": 0, "tensor_peak": None, "rss_after": None}
+
+        self._token_worker = threading.Thread(target=self._run_token_stage, name="token-stage", daemon=True)
+        self._decode_worker = threading.Thread(target=self._run_decode_stage, name="decode-stage", daemon=True)
+        self._token_worker.start()
+        self._decode_worker.start()
+
+    def submit(
+        self,
+        prompt,
+        output_path,
+        max_tokens=None,
+        num_variations=1,
+        seed=None,
+        postprocessor=None,
+        guidance_scale=None,
+        guidance_steps=None,
+        audio_prompt=None,
+    ):
+        """
+        提交一个生成请求
+
+        参数:
+            prompt (str): 音乐描述文本
+            output_path (str): 输出文件路径，多个变体时会加上 _1、_2 ... 后缀
+            max_tokens (int, 可选): 最大生成token数
+            num_variations (int): 生成的变体数量
+            seed (int, 可选): 随机种子
+            postprocessor (AudioPostProcessor, 可选): 音频后处理器
+            guidance_scale (float, 可选): 无分类器引导系数
+            guidance_steps (int, 可选): 只在前K步使用引导
+            audio_prompt (AudioPrompt, 可选): 续写的开头，生成的文件包含开头和续写的部分
+
+        返回值:
+            Future: 结果为dict，包含 variations（每个变体的信息）、seeds、timings（各阶段耗时）
+                和 memory（预估和实测的内存，见 _memory_result()）；
+                续写时还有 prompt（开头的哈希、是否命中缓存、编码耗时和节省的时间）
+
+        异常:
+            MemoryBudgetExceeded: 配置了内存守卫，且请求按策略无法在预算内完成
+        """
+        estimates = {}
+
+        def estimate(batch_size):
+            if batch_size not in estimates:
+                estimates[batch_size] = self.engine.estimate_memory(
+                    max_tokens=max_tokens,
+                    num_variations=batch_size,
+                    guidance_scale=guidance_scale,
+                    guidance_steps=guidance_steps,
+                    prompt_seconds=audio_prompt.duration if audio_prompt is not None else 0.0,
+                )
+            return estimates[batch_size]
+
+        # 在提交时检查内存预算，超出预算的请求直接在这里拒绝，不进入队列
+        batches = [num_variations]
+        if self.memory_guard is not None:
+            batches = self.memory_guard.plan(estimate, num_variations)
+
+        # 拆成几批时每批的种子要接着上一批，所以在这里先确定种子
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+
+        job = _Job(
+            prompt, output_path, max_tokens, num_variations, seed, guidance_scale, guidance_steps, postprocessor,
+            batches, estimate, audio_prompt,
+        )
+        self._token_queue.put(job)
+        return job.future
+
+    def stats(self):
+        """
+        各阶段的累计耗时统计、内存统计和续写开头的缓存统计
+
+        返回值:
+            dict: 阶段名 -> {count, total, mean}（单位：秒），
+                以及 memory -> {tokens_peak, decode_peak, tensor_peak, rss_after}（单位：字节）：
+                两个阶段RSS增量的最大值、张量内存增量的最大值（CPU上为None）、最近一次释放缓存后的RSS，
+                和 prompt_cache -> 续写开头的音频token缓存统计（见 AudioCodeCache.stats()）
+        """
+        with self._stats_lock:
+            stats = {
+                stage: {
+                    "count": values["count"],
+                    "total": values["total"],
+                    "mean": values["total"] / values["count"] if values["count"] else 0.0,
+                }
+                for stage, values in self._stats.items()
+            }
+            stats["memory"] = dict(self._memory_stats)
+        stats["prompt_cache"] = self.engine.code_cache.stats()
+        return stats
+
+    def shutdown(self, wait=True):
+        """
+        停止流水线，已经提交的请求会先处理完
+
+        参数:
+            wait (bool): 是否等待工作线程退出
+        """
+        self._token_queue.put(None)
+        if wait:
+            self._token_worker.join()
+            self._decode_worker.join()
+
+    def _record(self, timings, memory):
+        with self._stats_lock:
+            for stage, seconds in timings.items():
+                self._stats[stage]["count"] += 1
+                self._stats[stage]["total"] += seconds
+
+            stats = self._memory_stats
+            stats["tokens_peak"] = max(stats["tokens_peak"], memory["tokens"]["rss_delta"])
+            stats["decode_peak"] = max(stats["decode_peak"], memory["decode"]["rss_delta"])
+            for stage in ("tokens", "decode"):
+                tensor_delta = memory[stage]["tensor_delta"]
+                if tensor_delta is not None:
+                    stats["tensor_peak"] = max(stats["tensor_peak"] or 0, tensor_delta)
+            stats["rss_after"] = memory["rss_after"]
+
+    def _reserve(self, nbytes):
+        """在内存守卫中预留内存，没有守卫时不做任何事"""
+        if self.memory_guard is None:
+            return contextlib.nullcontext()
+        return self.memory_guard.reserve(nbytes)
+
+    def _memory_result(self, job):
+        """
+        汇总一个请求的内存信息
+
+        返回值:
+            dict: estimate（整个请求一次生成时的预估）、batches（每批的变体数量）、
+                tokens / decode（各阶段实测，见 MemoryTracker.result()）、rss_after（释放缓存后的RSS）
+        """
+        return {
+            "estimate": job.estimate(job.num_variations),
+            "batches": list(job.batches),
+            "tokens": job.memory["tokens"],
+            "decode": job.memory["decode"],
+            "rss_after": job.memory["rss_after"],
+        }
+
+    def _run_token_stage(self):
+        """token阶段的工作线程：依次为每个请求生成音频token"""
+        while True:
+            job = self._token_queue.get()
+            if job is None:
+                # 通知解码阶段退出
+                self._decode_queue.put(None)
+                return
+
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            job.timings["queue"] = time.perf_counter() - job.submitted
+
+            try:
+                # 续写：先把开头编码为音频token，同一段音频之前编码过时直接使用缓存
+                prompt_codes = None
+                if job.audio_prompt is not None:
+                    encoded = self.engine.encode_audio(job.audio_prompt)
+                    prompt_codes = encoded["audio_codes"]
+                    job.timings["encode"] = encoded["encode_time"]
+                    job.prompt_info = {
+                        "key": encoded["key"],
+                        "cached": encoded["cached"],
+                        "duration": encoded["duration"],
+                        "frames": prompt_codes.shape[-1],
+                        "encode_time": encoded["encode_time"],
+                        "saved_time": encoded["saved_time"],
+                    }
+
+                # 超出内存预算的请求拆成几批依次生成，第i批的种子从 seed + 前面的变体数 开始
+                chunks = []
+                offset = 0
+                for batch_size in job.batches:
+                    with self._reserve(job.estimate(batch_size)["tokens"]):
+                        chunks.append(self.engine.generate_codes(
+                            job.prompt,
+                            max_tokens=job.max_tokens,
+                            num_variations=batch_size,
+                            seed=job.seed + offset,
+                            guidance_scale=job.guidance_scale,
+                            guidance_steps=job.guidance_steps,
+                            audio_prompt=prompt_codes,
+                        ))
+                    offset += batch_size
+                job.codes = {
+                    "audio_codes": [chunk["audio_codes"] for chunk in chunks],
+                    "seeds": [seed for chunk in chunks for seed in chunk["seeds"]],
+                }
+                job.timings["tokens"] = sum(chunk["token_time"] for chunk in chunks)
+                job.memory["tokens"] = merge_memory_results([chunk["memory"] for chunk in chunks])
+                del chunks
+            except Exception as e:
+                job.future.set_exception(e)
+                release_memory(self.engine.device)
+                continue
+
+            # 队列满时在这里等待，形成背压；等待的时间和在队列中排队的时间一起计入 decode_queue
+            job.tokens_done = time.perf_counter()
+            self._decode_queue.put(job)
+
+    def _run_decode_stage(self):
+        """解码阶段的工作线程：音频解码、后处理、写文件"""
+        # CUDA上使用独立的stream，让解码可以和下一个请求的token生成并行
+        stream = None
+        if self.engine.device.type == "cuda":
+            stream = torch.cuda.Stream(device=self.engine.device)
+
+        while True:
+            job = self._decode_queue.get()
+            if job is None:
+                return
+            job.timings["decode_queue"] = time.perf_counter() - job.tokens_done
+
+            try:
+                if stream is not None:
+                    stream.wait_stream(torch.cuda.default_stream(self.engine.device))
+                chunks = []
+                for audio_codes in job.codes["audio_codes"]:
+                    with self._reserve(job.estimate(audio_codes.shape[0])["decode"]):
+                        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                            chunks.append(self.engine.decode_codes(audio_codes))
+                # 音频token已经用完，尽早释放
+                job.codes["audio_codes"] = None
+
+                start_time = time.perf_counter()
+                variations = self.engine.save_audio(
+                    [audio for chunk in chunks for audio in chunk["audio"]],
+                    chunks[0]["sampling_rate"],
+                    job.codes["seeds"],
+                    job.output_path,
+                    postprocessor=job.postprocessor,
+                )
+                job.timings["decode"] = sum(chunk["decode_time"] for chunk in chunks)
+                job.timings["write"] = time.perf_counter() - start_time
+                job.memory["decode"] = merge_memory_results([chunk["memory"] for chunk in chunks])
+                del chunks
+            except Exception as e:
+                job.future.set_exception(e)
+                continue
+            finally:
+                # 每个请求结束后显式释放缓存，让内存回到基线
+                release_memory(self.engine.device)
+
+            job.memory["rss_after"] = current_rss()
+            job.timings["total"] = time.perf_counter() - job.submitted
+            self._record(job.timings, job.memory)
+            result = {
+                "variations": variations,
+                "seeds": job.codes["seeds"],
+                "timings": dict(job.timings),
+                "memory": self._memory_result(job),
+            }
+            if job.prompt_info is not None:
+                result["prompt"] = job.prompt_info
+            job.future.set_result(result)
@@ -0,0 +1,244 @@
+"""
+模拟生成引擎模块
+
+StubMusicGen 和 MusicGen 的接口完全相同，但不加载任何模型权重：
+token生成和音频解码按照一个简单的延迟模型 sleep，然后返回合成的正弦波音频。
+流水线、文件写入、Web服务等其余部分都照常执行，
+所以可以在任何机器上单独测试服务层（排队、流水线、文件服务）的容量。
+
+延迟模型：
+- token阶段: 每一步 step_ms 毫秒；不使用引导的步骤只算一半（batch减半），
+  每多一个变体增加 variation_cost 倍的单步耗时
+- 解码阶段: 每秒音频 decode_ms 毫秒，乘以变体数量
+- 续写时编码开头: 每秒音频 encode_ms 毫秒（默认与解码相同）
+- 两个阶段都乘以一个对数正态分布的随机抖动
+
+使用示例:
+    engine = StubMusicGen(latency=LatencyModel(step_ms=5))
+    engine.generate("A calm piano melody", max_tokens=256, output_path="music.wav")
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入必要的库
+import math  # 用于计算抖动和帧数
+import random  # 用于生成随机种子和抖动
+import time  # 用于模拟耗时
+
+import numpy as np  # 用于合成音频
+import torch  # PyTorch深度学习框架
+
+# 作为包导入时使用相对导入，直接运行这个文件时使用同目录导入
+try:
+    from .continuation import AudioPrompt
+    from .memory import MemoryTracker, freeze_baseline
+    from .musicgen import DEFAULT_GUIDANCE_SCALE, MusicGen
+except ImportError:
+    from continuation import AudioPrompt
+    from memory import MemoryTracker, freeze_baseline
+    from musicgen import DEFAULT_GUIDANCE_SCALE, MusicGen
+
+# 与真实模型一致的音频参数：32kHz采样率，每秒50帧音频token，4个码本
+SAMPLING_RATE = 32000
+FRAME_RATE = 50
+NUM_CODEBOOKS = 4
+
+
+class LatencyModel:
+    """
+    模拟生成耗时的延迟模型
+
+    默认参数大致对应small模型在GPU上的耗时，可以按目标机器上 benchmark.py 的结果调整。
+    """
+
+    def __init__(
+        self, step_ms=15.0, variation_cost=0.1, decode_ms=20.0, jitter=0.1, load_seconds=0.0, seed=None, encode_ms=None
+    ):
+        """
+        参数:
+            step_ms (float): 使用引导时每一步解码的耗时（毫秒）
+            variation_cost (float): 每多一个变体，单步耗时增加的比例
+            decode_ms (float): 每秒音频的解码耗时（毫秒）
+            encode_ms (float, 可选): 续写时每秒开头音频的编码耗时（毫秒），默认与decode_ms相同
+            jitter (float): 随机抖动的对数标准差，0表示没有抖动
+            load_seconds (float): 模拟的模型加载耗时（秒）
+            seed (int, 可选): 抖动使用的随机种子
+        """
+        self.step_ms = step_ms
+        self.variation_cost = variation_cost
+        self.decode_ms = decode_ms
+        self.encode_ms = decode_ms if encode_ms is None else encode_ms
+        self.jitter = jitter
+        self.load_seconds = load_seconds
+        self._random = random.Random(seed)
+
+    def _jitter(self):
+        if self.jitter <= 0:
+            return 1.0
+        # 均值为1的对数正态分布
+        return self._random.lognormvariate(-self.jitter ** 2 / 2, self.jitter)
+
+    def token_seconds(self, max_tokens, num_variations, guided_steps):
+        """
+        token阶段的耗时（秒）
+
+        参数:
+            max_tokens (int): 生成的token数
+            num_variations (int): 变体数量
+            guided_steps (int): 使用引导的步数
+        """
+        steps = guided_steps + (max_tokens - guided_steps) / 2
+        batch_factor = 1 + self.variation_cost * (num_variations - 1)
+        return steps * self.step_ms / 1000 * batch_factor * self._jitter()
+
+    def decode_seconds(self, duration, num_variations):
+        """
+        解码阶段的耗时（秒）
+
+        参数:
+            duration (float): 每个变体的音频时长（秒）
+            num_variations (int): 变体数量
+        """
+        return duration * num_variations * self.decode_ms / 1000 * self._jitter()
+
+    def encode_seconds(self, duration):
+        """
+        续写时编码开头的耗时（秒）
+
+        参数:
+            duration (float): 开头音频的时长（秒）
+        """
+        return duration * self.encode_ms / 1000 * self._jitter()
+
+
+class StubMusicGen(MusicGen):
+    """
+    不加载模型的MusicGen，按延迟模型模拟token生成和音频解码
+
+    保存文件、后处理和 generate() 等方法直接继承自 MusicGen。
+    """
+
+    def __init__(self, model_size="small", device=None, compile=False, latency=None):
+        """
+        参数:
+            model_size (str): 模型大小，只影响默认的token数和文件名
+            device (torch.device): 忽略，始终使用CPU
+            compile (bool): 忽略，模拟引擎没有需要编译的模型
+            latency (LatencyModel, 可选): 延迟模型，默认使用 LatencyModel()
+        """
+        super().__init__(model_size=model_size, device=torch.device("cpu"))
+        self.latency = latency or LatencyModel()
+
+    def load_model(self):
+        """模拟模型加载，延迟模型就是这个引擎的"模型" """
+        print(f"🧪 使用模拟引擎代替 {self.model_name}")
+        time.sleep(self.latency.load_seconds)
+        self.model = self.latency
+        freeze_baseline()
+
+    def encode_waveform(self, audio, sampling_rate):
+        """
+        模拟续写时的开头编码：按延迟模型等待，返回全零的音频token
+
+        参数和返回值与 MusicGen.encode_waveform() 相同
+        """
+        duration = audio.shape[-1] / sampling_rate
+        start_time = time.time()
+        time.sleep(self.latency.encode_seconds(duration))
+        frames = math.ceil(duration * FRAME_RATE)
+        return {
+            "audio_codes": torch.zeros(1, NUM_CODEBOOKS, frames, dtype=torch.long),
+            "encode_time": time.time() - start_time,
+        }
+
+    def generate_codes(
+        self, prompt, max_tokens=None, num_variations=1, seed=None, guidance_scale=None, guidance_steps=None, audio_prompt=None
+    ):
+        """
+        模拟第一阶段：按延迟模型等待，返回全零的音频token（续写时开头的token原样保留）
+
+        参数、返回值和异常与 MusicGen.generate_codes() 相同
+        """
+        if num_variations < 1:
+            raise ValueError(f"变体数量必须至少为1: {num_variations}")
+        if self.model is None:
+            self.load_model()
+
+        max_tokens = max_tokens or self.get_default_max_tokens()
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        seeds = [seed + i for i in range(num_variations)]
+
+        # 与真实解码循环相同的规则计算使用引导的步数
+        guidance_scale = guidance_scale if guidance_scale is not None else DEFAULT_GUIDANCE_SCALE
+        guided_steps = 0
+        if guidance_scale > 1:
+            guided_steps = max_tokens if guidance_steps is None else min(guidance_steps, max_tokens)
+
+        start_time = time.time()
+        with MemoryTracker(self.device) as tracker:
+            time.sleep(self.latency.token_seconds(max_tokens, num_variations, guided_steps))
+
+            # 延迟模式会占用 (码本数 - 1) 步，与真实模型输出的帧数一致
+            frames = max(max_tokens - NUM_CODEBOOKS + 1, 1)
+            audio_codes = torch.zeros(num_variations, NUM_CODEBOOKS, frames, dtype=torch.long)
+            if audio_prompt is not None:
+                audio_codes = torch.cat([audio_prompt.expand(num_variations, -1, -1), audio_codes], dim=-1)
+        return {
+            "audio_codes": audio_codes,
+            "seeds": seeds,
+            "token_time": time.time() - start_time,
+            "memory": tracker.result(),
+        }
+
+    def decode_codes(self, audio_codes):
+        """
+        模拟第二阶段：按延迟模型等待，返回合成的正弦波音频
+
+        参数和返回值与 MusicGen.decode_codes() 相同
+        """
+        num_variations, _, frames = audio_codes.shape
+        samples = frames * SAMPLING_RATE // FRAME_RATE
+
+        start_time = time.time()
+        with MemoryTracker(self.device) as tracker:
+            time.sleep(self.latency.decode_seconds(samples / SAMPLING_RATE, num_variations))
+
+            # 每个变体使用不同音高的正弦波，方便试听时区分
+            t = np.arange(samples, dtype=np.float32) / SAMPLING_RATE
+            audio = [
+                (0.3 * np.sin(2 * math.pi * 220.0 * (i + 1) * t)).astype(np.float32)
+                for i in range(num_variations)
+            ]
+        return {
+            "audio": audio,
+            "sampling_rate": SAMPLING_RATE,
+            "decode_time": time.time() - start_time,
+            "memory": tracker.result(),
+        }
+
+
+# 如果直接运行这个文件，会执行以下测试代码
+if __name__ == "__main__":
+    print("🧪 测试模拟生成引擎...")
+    engine = StubMusicGen(latency=LatencyModel(step_ms=2, seed=0))
+    for options in ({}, {"guidance_steps": 32}, {"guidance_scale": 1.0}, {"num_variations": 4}):
+        start = time.time()
+        codes = engine.generate_codes("A simple piano melody", max_tokens=256, seed=0, **options)
+        decoded = engine.decode_codes(codes["audio_codes"])
+        durations = [len(audio) / decoded["sampling_rate"] for audio in decoded["audio"]]
+        print(
+            f"{str(options):<28} token {codes['token_time'] * 1000:6.1f}ms, "
+            f"解码 {decoded['decode_time'] * 1000:5.1f}ms, 时长 {durations[0]:.2f}秒 x {len(durations)}"
+        )
+
+    # 续写：同一段开头第二次续写时命中缓存，跳过编码
+    prompt = AudioPrompt(np.zeros((1, 5 * SAMPLING_RATE), dtype=np.float32), SAMPLING_RATE, key="intro")
+    for attempt in range(2):
+        encoded = engine.encode_audio(prompt)
+        codes = engine.generate_codes("A simple piano melody", max_tokens=256, seed=0, audio_prompt=encoded["audio_codes"])
+        print(
+            f"续写第{attempt + 1}次: 命中缓存 {encoded['cached']}, 编码 {encoded['encode_time'] * 1000:5.1f}ms, "
+            f"节省 {encoded['saved_time'] * 1000:5.1f}ms, 帧数 {codes['audio_codes'].shape[-1]}"
+        )
@@ -0,0 +1,499 @@
+"""
+音乐生成服务模块
+
+Web端（web_app.py 的Flask开发服务器和 asgi_app.py 的生产服务器）共用的服务层：
+- MusicGenerator: 一个模型对应一个生成引擎和一条生成流水线
+- MusicService: 管理所有模型的生成器，解析请求参数（/generate 从头生成，/continue 接着已有的音频续写），
+  整理响应内容，关闭时排空流水线；
+  配置了内存预算时，所有模型共用一个内存守卫（超出预算的请求被拒绝或拆分，并发请求按预算排队）
+
+HTTP处理函数只负责读取请求和返回响应，具体逻辑都在这里，
+所以两种服务器的行为完全一致。
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入必要的库
+import base64  # 续写请求中上传的音频使用base64编码
+import math  # 用于校验引导系数
+import os  # 用于处理文件路径
+import re  # 用于校验生成ID
+import threading  # 用于保护生成器的创建和模型加载
+import time  # 用于生成文件名
+import uuid  # 用于生成唯一文件名
+
+import torch  # PyTorch深度学习框架
+
+# 作为包导入时使用相对导入（from src.service import ...），直接在src目录下运行时使用同目录导入
+try:
+    from .models.continuation import AudioPrompt
+    from .models.decoding import FAST_GUIDANCE_STEPS
+    from .models.memory import GB, MB, MEMORY_POLICIES, MemoryBudgetExceeded, MemoryGuard
+    from .models.musicgen import MusicGen
+    from .models.pipeline import GenerationPipeline
+    from .models.stub import LatencyModel, StubMusicGen
+    from .utils.audio import AudioPostProcessor
+except ImportError:
+    from models.continuation import AudioPrompt
+    from models.decoding import FAST_GUIDANCE_STEPS
+    from models.memory import GB, MB, MEMORY_POLICIES, MemoryBudgetExceeded, MemoryGuard
+    from models.musicgen import MusicGen
+    from models.pipeline import GenerationPipeline
+    from models.stub import LatencyModel, StubMusicGen
+    from utils.audio import AudioPostProcessor
+
+# 静态文件目录（项目根目录下的static），生成的音频保存在其中的generated子目录
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
+UPLOAD_FOLDER = os.path.join(STATIC_FOLDER, "generated")
+
+# 可选的生成引擎：stub不加载模型，按延迟模型模拟耗时，用于压测服务层
+ENGINES = {
+    "musicgen": MusicGen,
+    "stub": StubMusicGen,
+}
+
+# 单次请求最多生成的变体数量
+MAX_VARIATIONS = 4
+
+# 生成档位对应的引导参数：fast只在前 FAST_GUIDANCE_STEPS 步使用无分类器引导，之后丢弃无条件分支
+TIERS = {
+    "standard": {},
+    "fast": {"guidance_steps": FAST_GUIDANCE_STEPS},
+}
+
+
+# 续写开头的最大时长：MusicGen最多处理2048个token（50帧/秒），
+# 30秒的开头加上medium模型默认的512个token仍在范围内
+MAX_PROMPT_SECONDS = 30.0
+
+# 生成ID就是生成文件名去掉扩展名，只允许这些字符，避免访问生成目录以外的文件
+GENERATION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class RequestError(ValueError):
+    """请求参数不合法，对应HTTP 400"""
+
+
+class ServiceUnavailable(RuntimeError):
+    """服务正在关闭，不再接受新的请求，对应HTTP 503"""
+
+
+def megabytes(nbytes):
+    """字节数转换为MB（保留一位小数），None保持不变"""
+    return None if nbytes is None else round(nbytes / MB, 1)
+
+
+class MusicGenerator:
+    """音乐生成器类 - 支持small和medium模型，生成过程由 MusicGen（或模拟引擎）完成"""
+
+    def __init__(self, model_size="small", compile=False, engine="musicgen", engine_options=None, memory_guard=None):
+        self.model_size = model_size
+        self.engine = ENGINES[engine](
+            model_size=model_size,
+            device=self._get_optimal_device(),
+            compile=compile,
+            **(engine_options or {})
+        )
+        self.pipeline = GenerationPipeline(self.engine, memory_guard=memory_guard)
+        self._load_lock = threading.Lock()
+
+    def _get_optimal_device(self):
+        """获取最优计算设备"""
+        if torch.backends.mps.is_available():
+            device = torch.device("mps")
+            print("🍏 使用Apple Silicon (MPS) 加速")
+        elif torch.cuda.is_available():
+            device = torch.device("cuda")
+            print(f"⚡ 使用CUDA加速: {torch.cuda.get_device_name()}")
+        else:
+            device = torch.device("cpu")
+            print("💻 使用CPU模式")
+        return device
+
+    def load_model(self):
+        """加载模型和处理器（并发请求只加载一次）"""
+        with self._load_lock:
+            if self.engine.model is None:
+                self.engine.load_model()
+
+    def submit(self, prompt, max_tokens=None, postprocessor=None, num_variations=1, seed=None,
+               guidance_scale=None, guidance_steps=None, audio_prompt=None):
+        """
+        提交生成请求，立即返回；指定audio_prompt（AudioPrompt）时接着这段音频续写
+
+        模型没有加载时，由流水线的token线程在处理第一个请求时加载，调用方不会被阻塞。
+
+        返回值:
+            Future: 结果为 GenerationPipeline.submit() 的结果
+
+        异常:
+            MemoryBudgetExceeded: 请求超出内存预算（并且按策略不能拆分）
+        """
+        # 生成唯一文件名
+        timestamp = int(time.time())
+        unique_id = str(uuid.uuid4())[:8]
+        output_path = os.path.join(UPLOAD_FOLDER, f"music_{self.model_size}_{timestamp}_{unique_id}.wav")
+
+        # 交给流水线：token生成和上一个请求的音频解码/写文件可以同时进行
+        return self.pipeline.submit(
+            prompt,
+            output_path,
+            max_tokens=max_tokens,
+            num_variations=num_variations,
+            seed=seed,
+            postprocessor=postprocessor,
+            guidance_scale=guidance_scale,
+            guidance_steps=guidance_steps,
+            audio_prompt=audio_prompt
+        )
+
+    def finish(self, result):
+        """
+        整理流水线的结果
+
+        参数:
+            result (dict): submit() 返回的Future的结果
+
+        返回值:
+            dict: 第一个变体的信息，以及 variations、generation_time、postprocess_time、timings、memory、model，
+                续写时还有 prompt（开头的缓存信息）
+        """
+        variations = result["variations"]
+        timings = result["timings"]
+        memory = result["memory"]
+        print(f"✅ 音乐生成完成! 共 {len(variations)} 个变体")
+        print(f"⏱️ 阶段耗时: " + ", ".join(f"{stage} {seconds:.2f}秒" for stage, seconds in timings.items()))
+        print(
+            f"💾 内存: 预估峰值 {megabytes(memory['estimate']['peak'])}MB, "
+            f"token阶段 +{megabytes(memory['tokens']['rss_delta'])}MB, "
+            f"解码阶段 +{megabytes(memory['decode']['rss_delta'])}MB, "
+            f"释放后RSS {megabytes(memory['rss_after'])}MB"
+        )
+        if "prompt" in result:
+            prompt = result["prompt"]
+            print(
+                f"🎧 续写开头: {prompt['duration']:.2f}秒, 命中缓存 {prompt['cached']}, "
+                f"编码 {prompt['encode_time']:.2f}秒, 节省 {prompt['saved_time']:.2f}秒"
+            )
+
+        # 第一个变体的信息放在顶层，兼容只生成一个文件的调用方
+        finished = {
+            **variations[0],
+            "variations": variations,
+            "generation_time": timings.get("encode", 0.0) + timings["tokens"] + timings["decode"],
+            "postprocess_time": sum(variation["postprocess_time"] for variation in variations),
+            "timings": timings,
+            "memory": memory,
+            "model": self.model_size
+        }
+        if "prompt" in result:
+            finished["prompt"] = result["prompt"]
+        return finished
+
+
+class MusicService:
+    """
+    Web服务共用的生成服务
+
+    使用示例:
+        service = MusicService(engine="stub")
+        request = service.parse_generate_request({"prompt": "A calm piano melody", "tier": "fast"})
+        future = service.submit(request)
+        response = service.generate_response(request, future.result())
+        service.shutdown()
+    """
+
+    def __init__(self, compile=False, engine="musicgen", engine_options=None, memory_budget=None, memory_policy="split"):
+        """
+        参数:
+            compile (bool): 是否编译解码步骤
+            engine (str): 生成引擎名称，见 ENGINES
+            engine_options (dict, 可选): 传给生成引擎的额外参数（例如模拟引擎的延迟模型）
+            memory_budget (int, 可选): 生成过程的内存预算（字节，不含模型权重），None表示不限制
+            memory_policy (str): 超出预算时的处理方式，见 MEMORY_POLICIES
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"不支持的生成引擎: {engine}")
+        self.compile = compile
+        self.engine = engine
+        self.engine_options = engine_options
+        # 所有模型共用一个内存守卫，因为它们在同一个进程中
+        self.memory_guard = MemoryGuard(memory_budget, memory_policy) if memory_budget else None
+        self.generators = {}
+        self.draining = False
+        self._lock = threading.Lock()
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+    def get_generator(self, model_size):
+        """获取或创建指定模型的生成器实例（并发的首个请求只会创建一个）"""
+        with self._lock:
+            if model_size not in self.generators:
+                self.generators[model_size] = MusicGenerator(
+                    model_size,
+                    compile=self.compile,
+                    engine=self.engine,
+                    engine_options=self.engine_options,
+                    memory_guard=self.memory_guard
+                )
+            return self.generators[model_size]
+
+    def parse_generate_request(self, data):
+        """
+        解析并校验 /generate 的请求参数
+
+        参数:
+            data (dict): 请求的JSON内容
+
+        返回值:
+            dict: model、tier，以及传给 MusicGenerator.submit() 的 options
+
+        异常:
+            RequestError: 参数不合法
+        """
+        if data is None:
+            data = {}
+        if not isinstance(data, dict):
+            raise RequestError("请求内容必须是JSON对象")
+        model_size = data.get("model", "small")
+        tier = data.get("tier", "standard")
+        if model_size not in ("small", "medium"):
+            raise RequestError("model 必须是 small 或 medium")
+        if tier not in TIERS:
+            raise RequestError(f"tier 必须是 {', '.join(TIERS)} 之一")
+
+        try:
+            num_variations = int(data.get("num_variations", 1))
+            seed = data.get("seed")
+
+            # 档位给出默认的引导参数，请求中显式指定的参数优先
+            options = dict(TIERS[tier])
+            if data.get("guidance_scale") is not None:
+                options["guidance_scale"] = float(data["guidance_scale"])
+            if data.get("guidance_steps") is not None:
+                options["guidance_steps"] = int(data["guidance_steps"])
+
+            # 可选的音频后处理（归一化、淡入淡出、重采样）
+            if data.get("postprocess"):
+                options["postprocessor"] = AudioPostProcessor(
+                    sample_rate=32000,  # MusicGen输出32kHz音频
+                    target_rate=data.get("sample_rate"),
+                    normalize=data.get("normalize", "peak"),
+                    fade_in=float(data.get("fade_in", 0.0)),
+                    fade_out=float(data.get("fade_out", 0.0)),
+                )
+
+            options.update(
+                prompt=str(data.get("prompt", "A calming piano melody")),
+                num_variations=num_variations,
+                seed=int(seed) if seed is not None else None,
+            )
+        except (TypeError, ValueError) as e:
+            raise RequestError(f"请求参数不合法: {e}")
+
+        if not 1 <= num_variations <= MAX_VARIATIONS:
+            raise RequestError(f"num_variations 必须在 1 到 {MAX_VARIATIONS} 之间")
+        if not math.isfinite(options.get("guidance_scale", 1.0)):
+            raise RequestError("guidance_scale 必须是有限的数")
+        # 负数的引导步数在解码循环中等同于全程引导，但内存预估会按不引导计算，必须拒绝
+        if options.get("guidance_steps", 0) < 0:
+            raise RequestError("guidance_steps 不能为负数")
+        return {"model": model_size, "tier": tier, "options": options}
+
+    def parse_continue_request(self, data):
+        """
+        解析并校验 /continue 的请求参数
+
+        除了 /generate 的参数之外，开头的音频二选一：
+        - generation_id: 之前某次生成的ID（响应中的 generation_id）
+        - audio: base64编码的WAV文件内容
+
+        参数:
+            data (dict): 请求的JSON内容
+
+        返回值:
+            dict: 与 parse_generate_request() 相同，options 中多了 audio_prompt（AudioPrompt）
+
+        异常:
+            RequestError: 参数不合法、找不到生成结果或者音频无法读取
+        """
+        # 先按 /generate 的参数校验（包括请求内容必须是JSON对象）
+        request = self.parse_generate_request(data)
+        data = data or {}
+        generation_id = data.get("generation_id")
+        audio = data.get("audio")
+        if (generation_id is None) == (audio is None):
+            raise RequestError("generation_id 和 audio 必须指定其中一个")
+
+        if generation_id is not None:
+            generation_id = str(generation_id)
+            path = os.path.join(UPLOAD_FOLDER, f"{generation_id}.wav")
+            if not GENERATION_ID_PATTERN.match(generation_id) or not os.path.isfile(path):
+                raise RequestError(f"找不到生成结果: {generation_id}")
+
+        try:
+            if generation_id is not None:
+                audio_prompt = AudioPrompt.from_file(path)
+            else:
+                # base64格式错误（binascii.Error）也是ValueError
+                audio_prompt = AudioPrompt.from_bytes(base64.b64decode(audio, validate=True))
+        except (TypeError, ValueError) as e:
+            raise RequestError(f"无法读取开头的音频: {e}")
+
+        if audio_prompt.duration > MAX_PROMPT_SECONDS:
+            raise RequestError(f"开头的音频最长 {MAX_PROMPT_SECONDS:.0f} 秒，当前为 {audio_prompt.duration:.1f} 秒")
+        request["options"]["audio_prompt"] = audio_prompt
+        return request
+
+    def submit(self, request):
+        """
+        提交一个已解析的生成请求，立即返回
+
+        参数:
+            request (dict): parse_generate_request() 或 parse_continue_request() 的返回值
+
+        返回值:
+            Future: 结果为 GenerationPipeline.submit() 的结果
+
+        异常:
+            ServiceUnavailable: 服务正在关闭
+            MemoryBudgetExceeded: 请求超出内存预算（并且按策略不能拆分）
+        """
+        if self.draining:
+            raise ServiceUnavailable("服务正在关闭，请稍后重试")
+        return self.get_generator(request["model"]).submit(**request["options"])
+
+    def generate_response(self, request, result):
+        """
+        把流水线的结果整理为 /generate 和 /continue 的响应内容
+
+        每个变体都有 generation_id，可以作为 /continue 的开头继续续写。
+        续写时还有 prompt：开头的哈希、时长、帧数、是否命中缓存、编码耗时，以及 time_saved（命中缓存节省的编码时间）。
+
+        参数:
+            request (dict): parse_generate_request() 或 parse_continue_request() 的返回值
+            result (dict): submit() 返回的Future的结果
+        """
+        result = self.get_generator(request["model"]).finish(result)
+        memory = result["memory"]
+        response = {
+            "success": True,
+            "audio_url": f"/static/generated/{result['filename']}",
+            "filename": result["filename"],
+            "generation_id": os.path.splitext(result["filename"])[0],
+            "duration": result["duration"],
+            "generation_time": result["generation_time"],
+            "postprocess_time": result["postprocess_time"],
+            "sample_rate": result["sample_rate"],
+            "timings": result["timings"],
+            "memory": {
+                "estimate_mb": {part: megabytes(nbytes) for part, nbytes in memory["estimate"].items()},
+                "batches": memory["batches"],
+                **{
+                    f"{stage}_{key}_mb": megabytes(memory[stage][key])
+                    for stage in ("tokens", "decode")
+                    for key in ("rss_peak", "rss_delta", "tensor_delta")
+                },
+                "rss_after_mb": megabytes(memory["rss_after"]),
+            },
+            "model": result["model"],
+            "tier": request["tier"],
+            "variations": [
+                {
+                    "audio_url": f"/static/generated/{variation['filename']}",
+                    "filename": variation["filename"],
+                    "generation_id": os.path.splitext(variation["filename"])[0],
+                    "duration": variation["duration"],
+                    "seed": variation["seed"]
+                }
+                for variation in result["variations"]
+            ]
+        }
+        if "prompt" in result:
+            prompt = result["prompt"]
+            response["prompt"] = {
+                "key": prompt["key"],
+                "duration": prompt["duration"],
+                "frames": prompt["frames"],
+                "cached": prompt["cached"],
+                "encode_time": prompt["encode_time"],
+                "time_saved": prompt["saved_time"],
+            }
+        return response
+
+    def stats(self):
+        """各模型流水线的阶段耗时和内存统计，配置了内存预算时还包括内存守卫的统计（memory_guard）"""
+        with self._lock:
+            generators = dict(self.generators)
+        stats = {model_size: generator.pipeline.stats() for model_size, generator in generators.items()}
+        if self.memory_guard is not None:
+            stats["memory_guard"] = self.memory_guard.stats()
+        return stats
+
+    def preload(self, model_sizes):
+        """提前创建生成器并加载模型，避免第一个请求等待模型加载"""
+        for model_size in model_sizes:
+            self.get_generator(model_size).load_model()
+
+    def shutdown(self, wait=True):
+        """
+        停止接受新请求，并排空所有流水线（已经提交的请求会先处理完）
+
+        参数:
+            wait (bool): 是否等待流水线处理完
+        """
+        self.draining = True
+        with self._lock:
+            generators = list(self.generators.values())
+        for generator in generators:
+            generator.pipeline.shutdown(wait=wait)
+
+
+def add_service_arguments(parser):
+    """
+    添加生成服务相关的命令行参数（web_app.py 和 asgi_app.py 共用）
+
+    参数:
+        parser (argparse.ArgumentParser): 命令行解析器
+    """
+    parser.add_argument("--compile", action="store_true", help="编译解码步骤（静态KV缓存 + torch.compile）")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="musicgen", help="生成引擎，stub为不加载模型的模拟引擎")
+    parser.add_argument("--stub-step-ms", type=float, default=15.0, help="模拟引擎：每一步解码的耗时（毫秒）")
+    parser.add_argument("--stub-decode-ms", type=float, default=20.0, help="模拟引擎：每秒音频的解码耗时（毫秒）")
+    parser.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        default=None,
+        help="生成过程的内存预算（GB，不含模型权重）；预估超出预算的请求按 --memory-policy 处理，并发请求按预算排队",
+    )
+    parser.add_argument(
+        "--memory-policy",
+        choices=MEMORY_POLICIES,
+        default="split",
+        help="超出内存预算时的处理方式：split把多个变体拆成几批生成，reject直接拒绝（HTTP 413）",
+    )
+
+
+def service_options(args):
+    """
+    把命令行参数转换为 MusicService 的构造参数
+
+    参数:
+        args (argparse.Namespace 或 dict): add_service_arguments() 添加的参数
+
+    返回值:
+        dict: compile、engine、engine_options、memory_budget、memory_policy
+    """
+    values = args if isinstance(args, dict) else vars(args)
+    memory_budget_gb = values.get("memory_budget_gb")
+    options = {
+        "compile": values.get("compile", False),
+        "engine": values.get("engine", "musicgen"),
+        "memory_budget": int(memory_budget_gb * GB) if memory_budget_gb else None,
+        "memory_policy": values.get("memory_policy", "split"),
+    }
+    if options["engine"] == "stub":
+        options["engine_options"] = {
+            "latency": LatencyModel(step_ms=values.get("stub_step_ms", 15.0), decode_ms=values.get("stub_decode_ms", 20.0))
+        }
+    return options
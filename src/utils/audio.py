@@ -0,0 +1,520 @@
+"""
+音频后处理模块
+
+这个模块负责对模型生成的原始音频做后处理，全部基于向量化的NumPy/SciPy实现：
+1. 去直流偏移（DC removal）
+2. 响度归一化（峰值归一化 / 类LUFS的响度归一化）
+3. 淡入淡出（fade in/out）
+4. 多相重采样（32kHz -> 44.1kHz / 48kHz）
+
+所有处理都是"分块"进行的：每个阶段都保存自己的状态，
+所以既可以一次处理整段音频，也可以处理流式到达的音频块，
+而不需要把整段音频放在内存里。
+
+作者: AI助手
+创建时间: 2024年
+"""
+
+# 导入必要的库
+import math  # 用于最大公约数等数学计算
+import time  # 用于统计每个阶段的耗时
+
+import numpy as np  # 向量化数值计算
+from scipy import signal  # 滤波器设计和滤波
+
+# 支持的输出采样率（常见的CD/视频采样率）
+SUPPORTED_SAMPLE_RATES = (44100, 48000)
+
+# 支持的归一化方式
+NORMALIZE_MODES = ("none", "peak", "loudness")
+
+
+def _db_to_gain(db):
+    """把分贝值转换为线性增益"""
+    return 10.0 ** (db / 20.0)
+
+
+class _DCBlocker:
+    """
+    去直流偏移阶段
+
+    使用一阶高通滤波器 y[n] = x[n] - x[n-1] + R * y[n-1]，
+    通过 scipy.signal.lfilter 的 zi 参数在块与块之间保存滤波器状态。
+    """
+
+    def __init__(self, sample_rate, channels, cutoff_hz=10.0):
+        # 根据截止频率计算极点位置 R（越接近1，截止频率越低）
+        r = math.exp(-2.0 * math.pi * cutoff_hz / sample_rate)
+        self.b = np.array([1.0, -1.0])
+        self.a = np.array([1.0, -r])
+        # 每个声道一份滤波器状态
+        self.zi = np.zeros((channels, 1))
+
+    def process(self, block):
+        block, self.zi = signal.lfilter(self.b, self.a, block, axis=-1, zi=self.zi)
+        return block
+
+    def flush(self, channels):
+        return np.zeros((channels, 0))
+
+
+class _Normalizer:
+    """
+    响度归一化阶段
+
+    - peak: 把峰值拉到目标电平（默认 -1 dBFS）
+    - loudness: 把门限后的RMS响度拉到目标电平（默认 -14 dBFS，类似LUFS但没有K加权），
+      同时保证峰值不超过 -1 dBFS
+
+    整段处理时先调用 prime() 用整段音频的统计量确定一个固定增益；
+    流式处理时使用累计的统计量，增益下降立即生效（避免削波），
+    增益上升则在块内线性过渡（避免咔哒声）。
+    """
+
+    # 峰值上限（dBFS），loudness模式下也会用它限制增益
+    PEAK_CEILING_DB = -1.0
+    # 响度统计的绝对门限（dBFS），低于这个电平的帧视为静音，不参与统计
+    GATE_DB = -70.0
+
+    def __init__(self, mode, target_db, sample_rate, max_gain_db=20.0):
+        self.mode = mode
+        self.target_db = target_db
+        self.max_gain = _db_to_gain(max_gain_db)
+        # 统计响度用的帧长：100毫秒
+        self.frame = max(1, int(sample_rate * 0.1))
+        self.peak = 0.0
+        self.energy = 0.0
+        self.frames = 0
+        self.gain = None
+        self.fixed = False
+
+    def _update(self, block):
+        # 更新峰值
+        if block.size:
+            self.peak = max(self.peak, float(np.max(np.abs(block))))
+
+        if self.mode != "loudness":
+            return
+
+        # 按100毫秒分帧，计算每帧的均方能量（多声道取平均）
+        usable = block.shape[-1] // self.frame * self.frame
+        if usable == 0:
+            return
+        frames = block[..., :usable].reshape(block.shape[0], -1, self.frame)
+        mean_square = np.mean(frames ** 2, axis=(0, 2))
+        # 绝对门限：去掉静音帧
+        gated = mean_square[mean_square > _db_to_gain(self.GATE_DB) ** 2]
+        self.energy += float(np.sum(gated))
+        self.frames += int(gated.size)
+
+    def _target_gain(self):
+        if self.peak <= 0.0:
+            return 1.0
+
+        ceiling_gain = _db_to_gain(self.PEAK_CEILING_DB) / self.peak
+        if self.mode == "peak":
+            gain = _db_to_gain(self.target_db) / self.peak
+        else:
+            if self.frames == 0:
+                return min(1.0, ceiling_gain)
+            rms = math.sqrt(self.energy / self.frames)
+            gain = min(_db_to_gain(self.target_db) / rms, ceiling_gain)
+
+        return min(gain, self.max_gain)
+
+    def prime(self, audio):
+        """用整段音频的统计量确定固定增益（整段处理时使用）"""
+        self._update(audio)
+        self.gain = self._target_gain()
+        self.fixed = True
+
+    def process(self, block):
+        if self.fixed:
+            return block * self.gain
+
+        self._update(block)
+        new_gain = self._target_gain()
+        old_gain = new_gain if self.gain is None else self.gain
+        self.gain = new_gain
+
+        if new_gain <= old_gain:
+            # 增益下降：立即生效，保证不会削波
+            return block * new_gain
+
+        # 增益上升：在块内线性过渡
+        ramp = np.linspace(old_gain, new_gain, block.shape[-1], endpoint=False)
+        return block * ramp
+
+    def flush(self, channels):
+        return np.zeros((channels, 0))
+
+
+class _Fader:
+    """
+    淡入淡出阶段
+
+    根据每个样本在整段音频中的位置计算包络。
+    淡出需要知道音频总长度，流式处理时如果不知道总长度则跳过淡出。
+    """
+
+    def __init__(self, sample_rate, fade_in, fade_out, total_samples=None):
+        self.fade_in = int(fade_in * sample_rate)
+        self.fade_out = int(fade_out * sample_rate)
+        self.total_samples = total_samples
+        self.position = 0
+
+    def process(self, block):
+        length = block.shape[-1]
+        index = np.arange(self.position, self.position + length)
+        self.position += length
+
+        envelope = np.ones(length)
+        if self.fade_in > 0:
+            envelope *= np.clip(index / self.fade_in, 0.0, 1.0)
+        if self.fade_out > 0 and self.total_samples is not None:
+            envelope *= np.clip((self.total_samples - index) / self.fade_out, 0.0, 1.0)
+        return block * envelope
+
+    def flush(self, channels):
+        return np.zeros((channels, 0))
+
+
+class _PolyphaseResampler:
+    """
+    流式多相重采样阶段
+
+    使用和 scipy.signal.resample_poly 相同的抗混叠滤波器（Kaiser窗FIR），
+    但把滤波器拆成 up 个相位，每个输出样本只计算它需要的那一个相位。
+    输入块之间只保留滤波器长度的历史样本，所以可以处理任意长的流。
+    """
+
+    # 每次计算的最大输出样本数，控制临时矩阵的内存占用
+    CHUNK = 8192
+
+    def __init__(self, orig_rate, target_rate, channels):
+        g = math.gcd(orig_rate, target_rate)
+        self.up = target_rate // g
+        self.down = orig_rate // g
+
+        # 滤波器设计与 resample_poly 默认参数保持一致
+        max_rate = max(self.up, self.down)
+        self.half_len = 10 * max_rate
+        h = signal.firwin(2 * self.half_len + 1, 1.0 / max_rate, window=("kaiser", 5.0)) * self.up
+
+        # 拆分为多相矩阵：h_poly[p, t] = h[p + t * up]
+        self.taps = -(-h.size // self.up)
+        padded = np.zeros(self.taps * self.up)
+        padded[:h.size] = h
+        self.h_poly = padded.reshape(self.taps, self.up).T
+
+        # 缓冲区前面补 taps-1 个零，对应信号开始之前的静音
+        self.buffer = np.zeros((channels, self.taps - 1))
+        self.base = -(self.taps - 1)  # buffer[:, 0] 对应的输入样本序号
+        self.received = 0  # 已经收到的输入样本数
+        self.next_output = 0  # 下一个要输出的样本序号
+
+    def _input_index(self, m):
+        # 第 m 个输出样本在"上采样域"中的位置（已补偿滤波器延迟）
+        return (m * self.down + self.half_len) // self.up
+
+    def _compute(self, end):
+        """计算 [next_output, end) 范围内的输出样本"""
+        pieces = []
+        taps = np.arange(self.taps)
+        for start in range(self.next_output, end, self.CHUNK):
+            m = np.arange(start, min(start + self.CHUNK, end))
+            n = m * self.down + self.half_len
+            phase = n % self.up
+            index = (n // self.up)[:, None] - taps[None, :] - self.base
+            # 一次性取出所有需要的输入样本，再与对应相位的系数做点积
+            pieces.append(np.einsum("mt,cmt->cm", self.h_poly[phase], self.buffer[:, index]))
+        self.next_output = max(self.next_output, end)
+
+        # 丢弃以后不再需要的历史样本
+        keep_from = self._input_index(self.next_output) - (self.taps - 1)
+        drop = min(max(0, keep_from - self.base), self.buffer.shape[-1])
+        self.buffer = self.buffer[:, drop:]
+        self.base += drop
+
+        if not pieces:
+            return np.zeros((self.buffer.shape[0], 0))
+        return np.concatenate(pieces, axis=-1)
+
+    def process(self, block):
+        self.buffer = np.concatenate([self.buffer, block], axis=-1)
+        self.received += block.shape[-1]
+        # 只输出所需输入样本已经全部到达的那些输出样本
+        end = -((self.half_len - self.received * self.up) // self.down)
+        return self._compute(max(end, self.next_output))
+
+    def flush(self, channels):
+        # 输出总长度与 resample_poly 一致：ceil(N * up / down)
+        total = -(-self.received * self.up // self.down)
+        if total <= self.next_output:
+            return np.zeros((channels, 0))
+        # 在末尾补零，让最后几个输出样本也能计算
+        needed = self._input_index(total - 1) + 1 - (self.base + self.buffer.shape[-1])
+        if needed > 0:
+            self.buffer = np.concatenate([self.buffer, np.zeros((channels, needed))], axis=-1)
+        return self._compute(total)
+
+
+class AudioPostProcessor:
+    """
+    音频后处理器
+
+    按顺序执行：去直流 -> 归一化 -> 淡入淡出 -> 重采样。
+    每个阶段的累计耗时保存在 timings 字典中（单位：秒）。
+
+    使用示例:
+        processor = AudioPostProcessor(sample_rate=32000, target_rate=44100,
+                                       normalize="loudness", fade_in=0.5, fade_out=2.0)
+
+        # 整段处理
+        output = processor.process(audio_numpy)
+
+        # 流式处理（按块输入，按块输出）
+        stream = processor.open_stream(total_samples=len(audio_numpy))
+        for block in blocks:
+            write(stream.process(block))
+        write(stream.flush())
+    """
+
+    def __init__(
+        self,
+        sample_rate,
+        target_rate=None,
+        normalize="peak",
+        target_db=None,
+        fade_in=0.0,
+        fade_out=0.0,
+        remove_dc=True,
+        block_size=32768,
+    ):
+        """
+        初始化后处理器
+
+        参数:
+            sample_rate (int): 输入音频的采样率（MusicGen为32000Hz）
+            target_rate (int, 可选): 输出采样率，44100或48000；None表示不重采样
+            normalize (str): 归一化方式，"none"、"peak" 或 "loudness"
+            target_db (float, 可选): 目标电平（dBFS），peak默认-1，loudness默认-14
+            fade_in (float): 淡入时长（秒）
+            fade_out (float): 淡出时长（秒）
+            remove_dc (bool): 是否去除直流偏移
+            block_size (int): 整段处理时内部使用的块大小（样本数）
+        """
+        if normalize not in NORMALIZE_MODES:
+            raise ValueError(f"不支持的归一化方式: {normalize}，可选: {NORMALIZE_MODES}")
+        if target_rate is not None and target_rate not in SUPPORTED_SAMPLE_RATES:
+            raise ValueError(f"不支持的采样率: {target_rate}，可选: {SUPPORTED_SAMPLE_RATES}")
+
+        self.sample_rate = sample_rate
+        self.target_rate = target_rate
+        self.normalize = normalize
+        if target_db is None:
+            target_db = -14.0 if normalize == "loudness" else -1.0
+        self.target_db = target_db
+        self.fade_in = fade_in
+        self.fade_out = fade_out
+        self.remove_dc = remove_dc
+        self.block_size = block_size
+        self.timings = {}
+
+    @property
+    def output_rate(self):
+        """输出音频的采样率"""
+        return self.target_rate or self.sample_rate
+
+    def reset_timings(self):
+        """清空各阶段的累计耗时"""
+        self.timings = {}
+
+    def open_stream(self, total_samples=None, channels=1):
+        """
+        创建一个流式处理会话
+
+        参数:
+            total_samples (int, 可选): 音频总样本数，已知时才会做淡出
+            channels (int): 声道数
+
+        返回值:
+            AudioStream: 流式处理对象，调用 process(block) 和 flush()
+        """
+        return AudioStream(self, self._build_stages(channels, total_samples), channels)
+
+    def process(self, audio):
+        """
+        整段处理音频
+
+        参数:
+            audio (np.ndarray): 形状为 (samples,) 或 (channels, samples) 的音频
+
+        返回值:
+            np.ndarray: 处理后的float32音频，形状与输入一致（采样点数可能因重采样变化）
+        """
+        mono = audio.ndim == 1
+        audio = np.atleast_2d(audio).astype(np.float64)
+        channels, total = audio.shape
+        if total == 0:
+            # 没有任何音频块时流式处理无法推断输出形状，空音频直接原样返回
+            output = audio.astype(np.float32)
+            return output[0] if mono else output
+
+        stream = self.open_stream(total_samples=total, channels=channels)
+
+        # 整段处理时可以先看到全部音频，用全局统计量确定固定增益
+        normalizer = stream.stages.get("normalize")
+        if normalizer is not None:
+            start = time.perf_counter()
+            source = audio
+            if self.remove_dc:
+                source = _DCBlocker(self.sample_rate, channels).process(audio)
+            normalizer.prime(source)
+            self._record("normalize", time.perf_counter() - start)
+
+        pieces = [stream.process(audio[:, i:i + self.block_size]) for i in range(0, total, self.block_size)]
+        pieces.append(stream.flush())
+        output = np.concatenate(pieces, axis=-1)
+        return output[0] if mono else output
+
+    def _build_stages(self, channels, total_samples):
+        # 使用普通dict保持插入顺序，也就是处理顺序
+        stages = {}
+        if self.remove_dc:
+            stages["dc"] = _DCBlocker(self.sample_rate, channels)
+        if self.normalize != "none":
+            stages["normalize"] = _Normalizer(self.normalize, self.target_db, self.sample_rate)
+        if self.fade_in > 0 or self.fade_out > 0:
+            stages["fade"] = _Fader(self.sample_rate, self.fade_in, self.fade_out, total_samples)
+        if self.target_rate is not None and self.target_rate != self.sample_rate:
+            stages["resample"] = _PolyphaseResampler(self.sample_rate, self.target_rate, channels)
+        return stages
+
+    def _record(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+
+class AudioStream:
+    """
+    流式处理会话
+
+    由 AudioPostProcessor.open_stream() 创建，依次把每个音频块送过所有阶段。
+    """
+
+    def __init__(self, processor, stages, channels):
+        self.processor = processor
+        self.stages = stages
+        self.channels = channels
+        # 输出形状跟随输入：输入一维就输出一维
+        self.mono = channels == 1
+
+    def process(self, block):
+        """
+        处理一个音频块
+
+        参数:
+            block (np.ndarray): 形状为 (samples,) 或 (channels, samples) 的音频块
+
+        返回值:
+            np.ndarray: 处理后的音频块（重采样阶段可能会暂存一部分样本）
+        """
+        self.mono = block.ndim == 1
+        block = np.atleast_2d(block).astype(np.float64)
+        for name, stage in self.stages.items():
+            start = time.perf_counter()
+            block = stage.process(block)
+            self.processor._record(name, time.perf_counter() - start)
+        return self._finish(block, self.mono)
+
+    def flush(self):
+        """
+        结束流，输出各阶段暂存的剩余样本
+
+        返回值:
+            np.ndarray: 剩余的音频样本
+        """
+        block = np.zeros((self.channels, 0))
+        for name, stage in self.stages.items():
+            start = time.perf_counter()
+            # 前面阶段吐出的尾部样本，还要经过后面的阶段
+            if block.shape[-1]:
+                block = stage.process(block)
+            block = np.concatenate([block, stage.flush(self.channels)], axis=-1)
+            self.processor._record(name, time.perf_counter() - start)
+        return self._finish(block, self.mono)
+
+    @staticmethod
+    def _finish(block, mono):
+        # 安全限幅，防止流式增益过渡时出现轻微削波
+        block = np.clip(block, -1.0, 1.0).astype(np.float32)
+        return block[0] if mono else block
+
+
+def benchmark(duration=30.0, sample_rate=32000, repeats=5):
+    """
+    后处理各阶段的微基准测试
+
+    用合成音频（正弦波 + 噪声 + 直流偏移）分别测量每个阶段的耗时，
+    并报告实时倍率（音频时长 / 处理耗时）。
+
+    参数:
+        duration (float): 测试音频时长（秒）
+        sample_rate (int): 测试音频采样率
+        repeats (int): 重复次数，取最好的一次
+
+    返回值:
+        dict: 阶段名 -> 最佳耗时（秒）
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    audio = (0.3 * np.sin(2 * np.pi * 440 * t) + 0.05 * rng.standard_normal(t.size) + 0.1).astype(np.float32)
+
+    configs = {
+        "dc": dict(normalize="none"),
+        "normalize": dict(normalize="loudness", remove_dc=False),
+        "fade": dict(normalize="none", remove_dc=False, fade_in=1.0, fade_out=2.0),
+        "resample": dict(normalize="none", remove_dc=False, target_rate=44100),
+    }
+
+    results = {}
+    for stage, options in configs.items():
+        best = float("inf")
+        for _ in range(repeats):
+            processor = AudioPostProcessor(sample_rate=sample_rate, **options)
+            processor.process(audio)
+            best = min(best, processor.timings[stage])
+        results[stage] = best
+    return results
+
+
+# 如果直接运行这个文件，会执行以下测试代码
+if __name__ == "__main__":
+    """
+    测试代码 - 当直接运行这个文件时执行
+    运行各阶段的微基准测试，并检查流式重采样与 scipy.signal.resample_poly 是否一致
+    """
+    print("🧪 测试音频后处理...")
+
+    duration = 30.0
+    for stage, seconds in benchmark(duration=duration).items():
+        print(f"⏱️ {stage:<10} {seconds * 1000:8.2f}毫秒  (实时倍率: {duration / seconds:,.0f}x)")
+
+    # 校验流式重采样的正确性
+    rng = np.random.default_rng(1)
+    audio = rng.standard_normal(32000 * 3) * 0.1
+    expected = signal.resample_poly(audio, 441, 320)
+    processor = AudioPostProcessor(sample_rate=32000, target_rate=44100, normalize="none", remove_dc=False)
+    stream = processor.open_stream(total_samples=audio.size)
+    blocks = [stream.process(audio[i:i + 4000]) for i in range(0, audio.size, 4000)]
+    blocks.append(stream.flush())
+    actual = np.concatenate(blocks)
+    error = np.max(np.abs(actual - expected)) if actual.shape == expected.shape else float("inf")
+    print(f"✅ 流式重采样最大误差: {error:.2e}" if error < 1e-5 else f"❌ 流式重采样不一致: {error}")
+
+    # 空音频：输出同样是空的，形状与输入一致
+    processor = AudioPostProcessor(sample_rate=32000, target_rate=44100, fade_in=0.1)
+    for empty in (np.zeros(0), np.zeros((1, 0)), np.zeros((2, 0))):
+        output = processor.process(empty)
+        status = "✅" if output.shape == empty.shape and output.dtype == np.float32 else "❌"
+        print(f"{status} 空音频 {empty.shape} -> {output.shape}")